@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from main import FileAppClient, FileAppServer, parse_byte_size
+
+'''
+Loopback benchmark: starts a FileAppServer and headless FileAppClients on localhost ports and measures
+registration latency, how long a table change takes to reach every client, OFFER ack latency and
+request_file throughput. Results are printed (or written) as JSON so runs of different versions can be compared.
+
+python bench.py --clients 8 --sizes 1K,1M,64M,1G --concurrency 1,4 --output results.json
+'''
+
+# how long a table change may take to reach every client before it is counted as lost
+PROPAGATION_TIMEOUT = 5.0
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    # milliseconds statistics of a list of durations in seconds
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = PROPAGATION_TIMEOUT) -> Optional[float]:
+    # Poll condition until it holds, returns the time it took or None on timeout
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            return None
+        time.sleep(0.0005)
+    return time.perf_counter() - start
+
+
+def write_test_file(path: str, size: int):
+    # random content, so neither compression nor deduplication shortcuts the transfer
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, 1024 * 1024)
+            f.write(os.urandom(block))
+            remaining -= block
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="filetransfer-bench-")
+        self.server = None
+        self.clients = []  # downloaders, every table change has to reach all of them
+        self.offerer = None  # offers files and seeds the transfers
+        self.next_port = args.base_port + 1
+
+    def start_server(self):
+        self.server = FileAppServer(self.args.base_port, broadcast_window=self.args.broadcast_window, print_interval=None)
+        target = self.server.run_async if self.args.async_server else self.server.run
+        threading.Thread(target=target, daemon=True).start()
+        time.sleep(0.1)
+
+    def new_client(self, name: str) -> FileAppClient:
+        udp_port, tcp_port = self.next_port, self.next_port + 1
+        self.next_port += 2
+        client = FileAppClient(name, "127.0.0.1", self.args.base_port, udp_port, tcp_port,
+                               codecs=self.args.codecs.split(",") if self.args.codecs else None)
+        directory = os.path.join(self.workdir, name)
+        os.makedirs(directory)
+        client.setdir(directory)
+        # run() reads the replies to register() and offer(), it has to be running first
+        threading.Thread(target=client.run, daemon=True).start()
+        threading.Thread(target=client.start_tcp_server, args=(tcp_port,), daemon=True).start()
+        return client
+
+    def bench_registration(self) -> Dict[str, Dict[str, float]]:
+        # Register the clients one at a time; every JOIN has to reach all clients registered before
+        registration = []
+        propagation = []
+        lost = 0
+        for i in range(self.args.clients):
+            client = self.new_client(f"client{i}")
+            start = time.perf_counter()
+            client.register()
+            registration.append(time.perf_counter() - start)
+            elapsed = wait_until(lambda: all(client.name in other.client_table for other in self.clients))
+            if elapsed is None:
+                lost += 1
+            elif self.clients:
+                propagation.append(time.perf_counter() - start)
+            self.clients.append(client)
+        return {"register": summarize(registration),
+                "join_propagation": dict(summarize(propagation), lost=lost)}
+
+    def bench_offer(self) -> Dict[str, Dict[str, float]]:
+        # OFFER round trips, and the time until every other client sees the offered file
+        offerer = self.offerer = self.new_client("offerer")
+        offerer.register()
+        ack = []
+        propagation = []
+        lost = 0
+        for i in range(self.args.offers):
+            filename = f"offer{i}.txt"
+            with open(os.path.join(offerer.dir, filename), "w") as f:
+                f.write(filename)
+            start = time.perf_counter()
+            offerer.offer(filename)
+            ack.append(time.perf_counter() - start)
+            elapsed = wait_until(lambda: all(offerer.name in client.file_index.lookup(filename) for client in self.clients))
+            if elapsed is None:
+                lost += 1
+            else:
+                propagation.append(time.perf_counter() - start)
+        return {"offer_ack": summarize(ack), "offer_propagation": dict(summarize(propagation), lost=lost)}
+
+    def bench_transfers(self) -> List[Dict]:
+        # request_file of every size from one seeder by 1..N downloaders at once
+        sizes = [parse_byte_size(size) for size in self.args.sizes.split(",")]
+        levels = [int(level) for level in self.args.concurrency.split(",")]
+        seeder = self.offerer
+        downloaders = self.clients
+        results = []
+        for size in sizes:
+            filename = f"file{size}.bin"
+            write_test_file(os.path.join(seeder.dir, filename), size)
+            seeder.offer(filename)
+            if wait_until(lambda: all(seeder.name in c.file_index.lookup(filename) for c in downloaders)) is None:
+                results.append({"size": size, "error": "offer did not reach the downloaders"})
+                continue
+            for level in levels:
+                if level > len(downloaders):
+                    continue
+                latencies = []
+                failures = 0
+                rounds = []
+                for _ in range(self.args.repeat):
+                    round_latencies = self.transfer_round(downloaders[:level], filename, seeder.name)
+                    failures += round_latencies.count(None)
+                    latencies += [latency for latency in round_latencies if latency is not None]
+                    rounds.append(max((latency for latency in round_latencies if latency is not None), default=0))
+                total_time = sum(rounds)
+                results.append({
+                    "size": size,
+                    "concurrency": level,
+                    "repeat": self.args.repeat,
+                    "failures": failures,
+                    "latency": summarize(latencies),
+                    "throughput_mb_s": size * len(latencies) / total_time / 1024 ** 2 if total_time else None,
+                })
+            os.remove(os.path.join(seeder.dir, filename))
+        return results
+
+    @staticmethod
+    def transfer_round(downloaders: List[FileAppClient], filename: str, owner: str) -> List[Optional[float]]:
+        # Download filename into every downloader at the same time, returns each download's duration (None: failed)
+        for client in downloaders:
+            # start from scratch: no partial file, and no local copy to link instead of downloading
+            for path in (os.path.join(client.dir, filename), os.path.join(client.dir, filename) + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
+            client.local_content.clear()
+        latencies = [None] * len(downloaders)
+
+        def download(i, client):
+            start = time.perf_counter()
+            if client.download(filename, [owner]):
+                latencies[i] = time.perf_counter() - start
+
+        threads = [threading.Thread(target=download, args=(i, client)) for i, client in enumerate(downloaders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies
+
+    def run(self) -> Dict:
+        self.start_server()
+        results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": {key: value for key, value in vars(self.args).items() if key != "output"},
+        }
+        results.update(self.bench_registration())
+        results.update(self.bench_offer())
+        results["transfers"] = self.bench_transfers()
+        results["server_metrics"] = self.server.metrics.snapshot()
+        return results
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File Transfer App loopback benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="Number of headless clients")
+    parser.add_argument("--offers", type=int, default=20, help="Number of OFFER round trips to time")
+    parser.add_argument("--sizes", default="1K,64K,1M,16M,128M", help="File sizes to transfer (e.g. 1K,1M,1G)")
+    parser.add_argument("--concurrency", default="1,4", help="Numbers of clients downloading at the same time")
+    parser.add_argument("--repeat", type=int, default=3, help="Transfers per size and concurrency level")
+    parser.add_argument("--base-port", type=int, default=47000, help="Server port, clients use the ports after it")
+    parser.add_argument("--async-server", action="store_true", help="Benchmark the asyncio server")
+    parser.add_argument("--broadcast-window", type=float, default=0.0, help="Broadcast window of the server")
+    parser.add_argument("--codecs", default=None, help="Compression codecs offered by the downloaders")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    # the clients and the server log every step (also from their threads after the run), keep that out of the results
+    results_file = open(args.output, "w") if args.output else sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    bench = Bench(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.cleanup()
+
+    results_file.write(json.dumps(results, indent=2) + "\n")
+    results_file.flush()
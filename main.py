@@ -3,11 +3,965 @@ import socket
 import threading
 from threading import Thread
 import time
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import signal
 import ipaddress
 import argparse
 import os
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import hashlib
+import json
+import fnmatch
+import bisect
+import shutil
+import zlib
+import lzma
+import logging
+import collections
+import random
+import contextlib
+
+# diagnostics (connections, transfers, peer errors) go through logging, see --log-level;
+# interactive answers to commands are printed
+logger = logging.getLogger("filetransfer")
+
+# size of the read buffer used for uploads when os.sendfile() is not available
+SEND_BUFFER_SIZE = 1024 * 1024
+
+# size of the reusable buffer downloads are received into and flushed to disk from; every chunk is
+# verified before it is written, so it holds a whole number of chunks (at least CHUNK_SIZE, rounded down)
+RECV_BUFFER_SIZE = 1024 * 1024
+
+# peer TCP response header: status byte, total file size, length of the returned byte range.
+# A BUSY response carries the number of milliseconds to wait before retrying in the file size field.
+RESPONSE_HEADER = struct.Struct("!BQQ")
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_BUSY = 2
+STATUS_FRAMED = 3
+
+# peer TCP server: upload worker threads, connections allowed to wait for a worker,
+# listen() backlog, per-connection read timeout in seconds and the retry delay sent with BUSY
+UPLOAD_WORKERS = 8
+UPLOAD_QUEUE = 32
+TCP_BACKLOG = 128
+READ_TIMEOUT = 10.0
+BUSY_RETRY_MS = 200
+
+# upload shaping: rate limited uploads are sent in slices of SHAPING_QUANTUM bytes, each granted by the
+# token buckets of the connection and of the whole client; a bucket holds at most SHAPING_BURST seconds of tokens
+SHAPING_QUANTUM = 64 * 1024
+SHAPING_BURST = 0.05
+
+# files are hashed, verified, journaled and stolen between peers in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# compressed transfers: a requester lists the codecs it accepts as "codecs=zlib,lzma" on a REQUEST line.
+# A STATUS_FRAMED response carries the range as frames of at most COMPRESSION_FRAME_SIZE logical bytes,
+# each a FRAME_HEADER (codec id, payload length on the wire) and the payload; codec 0 is raw bytes.
+# A frame is only sent compressed if that is smaller, so no frame is larger than COMPRESSION_FRAME_SIZE on
+# the wire or once decompressed; the receiver rejects anything bigger instead of buffering it.
+FRAME_HEADER = struct.Struct("!BI")
+CODEC_RAW = 0
+CODECS = {
+    "zlib": (1, lambda data: zlib.compress(data, 1), zlib.decompressobj),
+    "lzma": (2, lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+}
+DECOMPRESSORS = {codec_id: decompressor for codec_id, _, decompressor in CODECS.values()}
+COMPRESSION_FRAME_SIZE = CHUNK_SIZE
+
+# the first frames of a range are a sample: if they don't shrink below this wire/logical ratio
+# (archives, media) the rest of the range is sent raw, zero-copy
+COMPRESSION_SAMPLE_FRAMES = 2
+COMPRESSION_MIN_RATIO = 0.9
+
+# bytes of the content hash advertised for every offered file (hex encoded in text messages)
+CONTENT_HASH_SIZE = 16
+
+# parallel downloads: smallest segment handed out to a peer (a multiple of CHUNK_SIZE)
+MIN_SEGMENT_SIZE = 2 * CHUNK_SIZE
+
+# how often a peer is retried after a failed segment, and the first backoff delay in seconds
+DOWNLOAD_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# how often a busy peer is asked again before it is given up on
+BUSY_RETRIES = 10
+
+# owner selection: a PING is answered with an OK header carrying the uploads in progress or waiting
+# in the file size field and the number of upload workers in the length field; peers that don't answer
+# within PING_TIMEOUT seconds are not asked for the file. At most PING_SAMPLE owners, picked at random,
+# are asked, the others are only tried if none of those can serve the file.
+PING_TIMEOUT = 1.0
+PING_SAMPLE = 4
+
+# persistent peer connections: how long the serving peer waits for the next request on a connection
+# (an idle connection still holds an upload worker, so this is short, and a new connection takes the
+# worker of an idle one when all are in use), idle connections kept per peer, how long the requesting
+# side keeps one before closing it (below KEEPALIVE_TIMEOUT so it is not reused right as the peer closes
+# it) and how many requests a batch keeps in flight
+KEEPALIVE_TIMEOUT = 1.0
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 0.5
+PIPELINE_DEPTH = 16
+
+# how long a new peer connection waits for the worker of an idle connection that was closed for it,
+# and the threads that do this waiting and the BUSY rejections, off the accept loop
+IDLE_HANDOVER_TIMEOUT = 0.1
+ADMISSION_WORKERS = 2
+
+# UDP control messages: largest datagram accepted, and the payload size messages are fragmented into
+# (kept below a typical 1500 byte MTU so fragments are not split again by IP)
+MAX_DATAGRAM_SIZE = 65535
+FRAGMENT_PAYLOAD_SIZE = 1200
+UDP_RCVBUF = 4 * 1024 * 1024
+
+# fragment header: magic, message id, sequence number, fragment count
+FRAGMENT_MAGIC = b"\x00FRG"
+FRAGMENT_HEADER = struct.Struct("!4sIHH")
+
+# control requests from clients to the server: "REQ <id> <message>" is answered by "REP <id> <reply>".
+# Unanswered requests are sent again after CONTROL_TIMEOUT seconds, doubling every time, CONTROL_RETRIES times.
+# The server remembers the replies it sent, so a retransmitted request is answered without running it twice.
+# Replies are kept for REPLY_CACHE_TTL seconds, longer than a client retransmits, and at most
+# REPLY_CACHE_SIZE of them taking REPLY_CACHE_BYTES. Replies that need more than one datagram (WELCOME,
+# STATS) are not kept, the server builds them again for a retransmission.
+CONTROL_TIMEOUT = 0.25
+CONTROL_RETRIES = 4
+REPLY_CACHE_SIZE = 4096
+REPLY_CACHE_TTL = CONTROL_TIMEOUT * 2 ** (CONTROL_RETRIES + 1)
+REPLY_CACHE_BYTES = 4 * 1024 * 1024
+
+# liveness: clients send HEARTBEAT every HEARTBEAT_INTERVAL seconds, the server marks a client offline
+# after HEARTBEAT_TIMEOUT seconds without one and drops offline entries after DEAD_ENTRY_TTL seconds.
+# Deadlines are kept in a timer wheel of TIMER_SLOTS slots of TIMER_TICK seconds.
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+DEAD_ENTRY_TTL = 3600.0
+TIMER_TICK = 0.5
+TIMER_SLOTS = 512
+
+# OFFER/WITHDRAW batches: client messages to the server are single datagrams, so long file lists are
+# split into messages of at most CONTROL_MESSAGE_SIZE bytes, CONTROL_WINDOW of them in flight at once
+CONTROL_MESSAGE_SIZE = FRAGMENT_PAYLOAD_SIZE - 32
+CONTROL_WINDOW = 32
+
+# seconds between rescans of the shared directory in watch mode
+WATCH_INTERVAL = 5.0
+
+# deltas appended to the server's state log before the snapshot is rewritten and the log truncated
+STATE_COMPACT_EVERY = 10000
+
+# SEARCH results per page
+SEARCH_PAGE_SIZE = 100
+
+# metrics: upper bounds in milliseconds of the latency histogram buckets, transfers kept for the dump,
+# and the message types the server counts separately
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+TRANSFER_HISTORY = 20
+SERVER_MESSAGES = ("REGISTER", "DEREG", "DISCONNECT", "HEARTBEAT", "ACK", "OFFER", "WITHDRAW", "SNAPSHOT",
+                   "SEARCH", "STATS")
+
+# binary client table: format byte, table version, string table, rows
+TABLE_FORMAT_VERSION = 2
+PORTS = struct.Struct("!HH")
+
+
+def format_throughput(num_bytes: int, elapsed: float) -> str:
+    # human readable summary of a transfer, used by the upload/download logs
+    rate = num_bytes / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+    return f"{num_bytes} bytes in {elapsed:.3f}s ({rate:.2f} MB/s)"
+
+
+def parse_byte_size(text: str) -> int:
+    # "512K", "10M", "1G" or a plain number of bytes, used for sizes and rates on the command line
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_wire(wire_bytes: int, logical_bytes: int) -> str:
+    # bytes that crossed the network for a transfer of logical_bytes, with the compression ratio
+    ratio = logical_bytes / wire_bytes if wire_bytes else 1.0
+    return f"{wire_bytes} bytes on the wire, {ratio:.2f}x"
+
+
+def content_hash(digests: List[bytes]) -> str:
+    # Identity of a file's content, derived from its chunk hashes so it costs no extra pass over the file
+    return hashlib.sha256(b"".join(digests)).hexdigest()[:CONTENT_HASH_SIZE * 2]
+
+
+def split_file_token(token: str) -> Tuple[str, Optional[str]]:
+    # "<filename>:<content hash>" as sent in OFFER and deltas, the hash part is optional
+    filename, sep, digest = token.rpartition(":")
+    if sep and len(digest) == CONTENT_HASH_SIZE * 2 and all(c in "0123456789abcdef" for c in digest):
+        return filename, digest
+    return token, None
+
+
+def scan_directory(root: str) -> Dict[str, Tuple[int, int]]:
+    # (size, mtime_ns) of every regular file below root, keyed by its path relative to root with "/"
+    # separators. Skipped: symlinks, names with whitespace (the protocol separates names by spaces),
+    # journals and the partial downloads they belong to.
+    snapshot = {}
+    directories = [""]
+    while directories:
+        relative = directories.pop()
+        try:
+            with os.scandir(os.path.join(root, relative) if relative else root) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            if any(c.isspace() for c in entry.name):
+                continue
+            name = f"{relative}/{entry.name}" if relative else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(name)
+                elif (entry.is_file(follow_symlinks=False) and not entry.name.endswith(DownloadJournal.SUFFIX)
+                      and entry.name + DownloadJournal.SUFFIX not in names):
+                    stat = entry.stat(follow_symlinks=False)
+                    snapshot[name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue  # removed while scanning
+    return snapshot
+
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_table(version: int, table: Dict[str, Dict[str, Union[str, int, List[str], bool]]]) -> bytes:
+    # Compact binary form of the client table. Names, IPs and filenames are interned in a string
+    # table, so a file offered by many clients is sent once and rows only carry varint indexes.
+    strings = {}
+    rows = bytearray()
+    encode_varint(len(table), rows)
+    for name, info in table.items():
+        for value in (name, info["ip"]):
+            encode_varint(strings.setdefault(value, len(strings)), rows)
+        rows += PORTS.pack(info["udp_port"], info["tcp_port"])
+        rows.append(int(info["online"]))
+        encode_varint(len(info["files"]), rows)
+        hashes = info.get("hashes", {})
+        for filename in info["files"]:
+            encode_varint(strings.setdefault(filename, len(strings)), rows)
+            digest = hashes.get(filename)
+            if digest:
+                rows.append(1)
+                rows += bytes.fromhex(digest)
+            else:
+                rows.append(0)
+
+    out = bytearray([TABLE_FORMAT_VERSION])
+    encode_varint(version, out)
+    encode_varint(len(strings), out)
+    for value in strings:
+        encoded = value.encode()
+        encode_varint(len(encoded), out)
+        out += encoded
+    return bytes(out + rows)
+
+
+def decode_table(data: bytes) -> Tuple[int, Dict[str, Dict[str, Union[str, int, List[str], bool]]]]:
+    if data[0] != TABLE_FORMAT_VERSION:
+        raise ValueError(f"unsupported table format {data[0]}")
+    version, pos = decode_varint(data, 1)
+    count, pos = decode_varint(data, pos)
+    strings = []
+    for _ in range(count):
+        length, pos = decode_varint(data, pos)
+        strings.append(data[pos:pos + length].decode())
+        pos += length
+
+    table = {}
+    count, pos = decode_varint(data, pos)
+    for _ in range(count):
+        name, pos = decode_varint(data, pos)
+        ip, pos = decode_varint(data, pos)
+        udp_port, tcp_port = PORTS.unpack_from(data, pos)
+        online = data[pos + PORTS.size]
+        pos += PORTS.size + 1
+        file_count, pos = decode_varint(data, pos)
+        files = []
+        hashes = {}
+        for _ in range(file_count):
+            index, pos = decode_varint(data, pos)
+            files.append(strings[index])
+            if data[pos]:
+                hashes[strings[index]] = data[pos + 1:pos + 1 + CONTENT_HASH_SIZE].hex()
+                pos += CONTENT_HASH_SIZE
+            pos += 1
+        table[strings[name]] = {
+            "ip": strings[ip],
+            "udp_port": udp_port,
+            "tcp_port": tcp_port,
+            "files": files,
+            "hashes": hashes,
+            "online": bool(online)
+        }
+    return version, table
+
+
+def apply_table_op(table: Dict[str, Dict[str, Union[str, int, List[str], bool]]], file_index: "FileIndex",
+                   op: str) -> Tuple[str, str]:
+    # Apply one delta op to a client table and its index in place, returns (op name, client name).
+    # Clients apply the ops broadcast by the server, the server replays its own from the state log.
+    op_name, name, *args = op.split(" ")
+    if op_name == "JOIN":
+        ip, udp_port, tcp_port, *tokens = args
+        files = [split_file_token(token) for token in tokens if token]
+        table[name] = {
+            "ip": ip,
+            "udp_port": int(udp_port),
+            "tcp_port": int(tcp_port),
+            "files": [filename for filename, _ in files],
+            "hashes": {filename: digest for filename, digest in files if digest},
+            "online": True
+        }
+        for filename in table[name]["files"]:
+            file_index.add(filename, name)
+    elif op_name == "LEAVE":
+        if name in table:
+            table[name]["online"] = False
+    elif op_name == "WITHDRAW":
+        if name in table:
+            info = table[name]
+            withdrawn = {filename for filename in args if name in file_index.lookup(filename)}
+            for filename in withdrawn:
+                file_index.remove(filename, name)
+                info.get("hashes", {}).pop(filename, None)
+            if withdrawn:
+                info["files"] = [filename for filename in info["files"] if filename not in withdrawn]
+    elif op_name == "REMOVE":
+        # an entry that was offline for long is dropped from the table
+        info = table.pop(name, None)
+        if info is not None:
+            for filename in info["files"]:
+                file_index.remove(filename, name)
+    elif op_name == "FILES":
+        if name in table:
+            info = table[name]
+            for token in args:
+                filename, digest = split_file_token(token)
+                if digest:
+                    info.setdefault("hashes", {})[filename] = digest
+                if name not in file_index.lookup(filename):
+                    info["files"].append(filename)
+                    file_index.add(filename, name)
+    # anything else (BUMP after a server restart) only moves the version
+    return op_name, name
+
+
+def fragment_message(message: bytes, message_id: int) -> List[bytes]:
+    # Split a control message into datagrams of at most FRAGMENT_PAYLOAD_SIZE bytes.
+    # Short messages are sent unchanged, so plain text commands stay readable.
+    if len(message) <= FRAGMENT_PAYLOAD_SIZE:
+        return [message]
+    total = -(-len(message) // FRAGMENT_PAYLOAD_SIZE)
+    return [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, message_id, seq, total)
+            + message[seq * FRAGMENT_PAYLOAD_SIZE:(seq + 1) * FRAGMENT_PAYLOAD_SIZE]
+            for seq in range(total)]
+
+
+class FragmentAssembler:
+    # Reassembles messages split by fragment_message(). Incomplete messages are dropped after
+    # timeout seconds, the sender recovers from lost fragments by resending the whole message.
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+        self.partial = {}
+
+    def add(self, datagram: bytes) -> Optional[bytes]:
+        # returns the complete message once all of its fragments arrived, otherwise None
+        if not datagram.startswith(FRAGMENT_MAGIC):
+            return datagram
+        _, message_id, seq, total = FRAGMENT_HEADER.unpack_from(datagram)
+        now = time.monotonic()
+        for stale_id in [key for key, (_, started, _) in self.partial.items() if now - started > self.timeout]:
+            del self.partial[stale_id]
+
+        parts = self.partial.setdefault(message_id, ({}, now, total))[0]
+        parts[seq] = datagram[FRAGMENT_HEADER.size:]
+        if len(parts) < total:
+            return None
+        del self.partial[message_id]
+        return b"".join(parts[i] for i in range(total))
+
+
+class FileIndex:
+    # Inverted index of the client table: filename -> owners. Filenames are also kept sorted for
+    # prefix lookups and indexed by their trigrams for substring lookups, so neither needs a scan
+    # over every row. Maintained incrementally as files are offered.
+    def __init__(self):
+        self.owners = {}
+        self.sorted_names = []
+        self.trigrams = {}
+
+    @classmethod
+    def from_table(cls, table: Dict[str, Dict[str, Union[str, int, List[str], bool]]]) -> "FileIndex":
+        index = cls()
+        for name, info in table.items():
+            for filename in info["files"]:
+                index.add(filename, name)
+        return index
+
+    def add(self, filename: str, owner: str):
+        owners = self.owners.get(filename)
+        if owners is None:
+            owners = self.owners[filename] = set()
+            bisect.insort(self.sorted_names, filename)
+            for i in range(len(filename) - 2):
+                self.trigrams.setdefault(filename[i:i + 3], set()).add(filename)
+        owners.add(owner)
+
+    def remove(self, filename: str, owner: str):
+        owners = self.owners.get(filename)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if owners:
+            return
+        del self.owners[filename]
+        del self.sorted_names[bisect.bisect_left(self.sorted_names, filename)]
+        for i in range(len(filename) - 2):
+            names = self.trigrams.get(filename[i:i + 3])
+            if names is not None:
+                names.discard(filename)
+                if not names:
+                    del self.trigrams[filename[i:i + 3]]
+
+    def lookup(self, filename: str) -> set:
+        return self.owners.get(filename, set())
+
+    def prefix(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names, prefix + "\U0010ffff")
+        return self.sorted_names[start:end]
+
+    def substring(self, text: str) -> List[str]:
+        if len(text) < 3:
+            return [filename for filename in self.sorted_names if text in filename]
+        # intersect the posting sets of all trigrams, starting with the rarest
+        postings = sorted((self.trigrams.get(text[i:i + 3], set()) for i in range(len(text) - 2)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return sorted(filename for filename in candidates if text in filename)
+
+    def search(self, pattern: str) -> List[str]:
+        # Sorted filenames matching pattern: a glob if it contains *, ? or [, otherwise a substring
+        wildcard = min((i for i, c in enumerate(pattern) if c in "*?["), default=None)
+        if wildcard is None:
+            return self.substring(pattern)
+        if wildcard > 0:
+            candidates = self.prefix(pattern[:wildcard])
+        else:
+            # narrow down with the longest literal part of the pattern
+            literal = max(glob_literals(pattern), key=len)
+            candidates = self.substring(literal) if literal else self.sorted_names
+        return [filename for filename in candidates if fnmatch.fnmatchcase(filename, pattern)]
+
+
+def glob_literals(pattern: str) -> List[str]:
+    # literal parts of a glob pattern, e.g. "*log_?.csv" -> ["log_", ".csv"]
+    parts = [""]
+    in_class = False
+    for c in pattern:
+        if in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+            parts.append("")
+        elif c in "*?":
+            parts.append("")
+        else:
+            parts[-1] += c
+    return parts
+
+
+class Metrics:
+    # Counters, gauges and latency histograms shared by the threads of a client or the server.
+    # snapshot() returns everything as a JSON friendly dict, sent in reply to STATS and dumped by "stats".
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        # gauges computed when a snapshot is taken, e.g. queue lengths
+        self.gauge_functions = {}
+        # name -> [count, total seconds, max seconds, count per bucket (the last one unbounded)]
+        self.histograms = {}
+        self.transfers = collections.deque(maxlen=TRANSFER_HISTORY)
+
+    def incr(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_gauge(self, name: str, delta: int):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def gauge(self, name: str, function):
+        self.gauge_functions[name] = function
+
+    def observe(self, name: str, seconds: float):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS_MS) + 1)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][bucket] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def record_transfer(self, kind: str, filename: str, logical_bytes: int, wire_bytes: int, elapsed: float,
+                        throttled: float = 0.0):
+        # a finished upload/download: totals, a duration histogram and the recent transfers with their rate
+        # (throttled: seconds spent waiting for the upload rate limits)
+        self.incr(f"{kind}.count")
+        self.incr(f"{kind}.bytes", logical_bytes)
+        self.incr(f"{kind}.wire_bytes", wire_bytes)
+        self.observe(f"{kind}.duration", elapsed)
+        with self.lock:
+            self.transfers.append({
+                "kind": kind,
+                "file": filename,
+                "bytes": logical_bytes,
+                "wire_bytes": wire_bytes,
+                "seconds": round(elapsed, 6),
+                "throttled_seconds": round(throttled, 6),
+                "bytes_per_second": round(logical_bytes / elapsed) if elapsed > 0 else None,
+            })
+
+    def snapshot(self) -> dict:
+        gauges = {name: function() for name, function in list(self.gauge_functions.items())}
+        with self.lock:
+            gauges.update(self.gauges)
+            histograms = {}
+            for name, (count, total, maximum, buckets) in self.histograms.items():
+                bounds = [str(bound) for bound in LATENCY_BUCKETS_MS] + ["inf"]
+                histograms[name] = {
+                    "count": count,
+                    "mean_ms": round(total / count * 1000, 3),
+                    "max_ms": round(maximum * 1000, 3),
+                    "buckets_ms": dict(zip(bounds, buckets)),
+                }
+            return {
+                "uptime_s": round(time.monotonic() - self.started, 3),
+                "counters": dict(self.counters),
+                "gauges": gauges,
+                "histograms": histograms,
+                "transfers": list(self.transfers),
+            }
+
+
+class TimerWheel:
+    # Hashed timing wheel: a deadline goes into the slot of its tick, so scheduling, rescheduling and
+    # cancelling are O(1) and advancing only looks at the slots of the ticks that passed, however many
+    # keys are scheduled. Deadlines further away than one turn of the wheel wait in their slot for later turns.
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # key -> tick number
+        self.current = int(time.monotonic() / tick)
+
+    def schedule(self, key, delay: float):
+        # (re)schedule key to expire delay seconds from now
+        self.cancel(key)
+        due = max(int((time.monotonic() + delay) / self.tick), self.current + 1)
+        self.deadlines[key] = due
+        self.slots[due % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        due = self.deadlines.pop(key, None)
+        if due is not None:
+            self.slots[due % len(self.slots)].discard(key)
+
+    def advance(self) -> list:
+        # keys whose deadline passed since the last call
+        target = int(time.monotonic() / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key] <= self.current]:
+                slot.discard(key)
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+
+class PeerBusy(Exception):
+    # the peer's upload queue is full, retry_after is in seconds
+    def __init__(self, retry_after: float):
+        super().__init__(f"peer busy, retry after {retry_after * 1000:.0f} ms")
+        self.retry_after = retry_after
+
+
+class ControlChannel:
+    # Request/response layer for client -> server control messages. Every request gets an id and a future;
+    # the one thread reading the socket (FileAppClient.run) completes the future when the reply with that
+    # id arrives. Requests are retransmitted with exponential backoff, several can be in flight at once.
+    def __init__(self, sock: socket.socket, address: Tuple[str, int], metrics: "Metrics",
+                 timeout: float = CONTROL_TIMEOUT, retries: int = CONTROL_RETRIES):
+        self.sock = sock
+        self.address = address
+        self.metrics = metrics
+        self.timeout = timeout
+        self.retries = retries
+        # ids start at a random point, a restarted client must not get the cached replies of its predecessor
+        self.next_id = int.from_bytes(os.urandom(4), "big") >> 1
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def call(self, message: bytes) -> Optional[bytes]:
+        # send one request and wait for its reply, None if the server never answered
+        return self.call_many([message])[0]
+
+    def call_many(self, messages: List[bytes]) -> List[Optional[bytes]]:
+        # send all requests at once and wait for their replies, in the same order
+        requests = []
+        with self.lock:
+            for message in messages:
+                request_id = self.next_id
+                self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+                future = Future()
+                self.pending[request_id] = future
+                requests.append((request_id, f"REQ {request_id} ".encode() + message, future))
+
+        start = time.perf_counter()
+        delay = self.timeout
+        for attempt in range(self.retries + 1):
+            waiting = [(data, future) for _, data, future in requests if not future.done()]
+            if not waiting:
+                break
+            if attempt:
+                self.metrics.incr("control.retransmits", len(waiting))
+            for data, _ in waiting:
+                self.sock.sendto(data, self.address)
+            wait([future for _, future in waiting], timeout=delay)
+            delay *= 2
+
+        replies = []
+        with self.lock:
+            for request_id, _, future in requests:
+                self.pending.pop(request_id, None)
+                replies.append(future.result() if future.done() else None)
+        self.metrics.incr("control.timeouts", replies.count(None))
+        self.metrics.observe("control.round_trip", time.perf_counter() - start)
+        return replies
+
+    def take(self, request_id: int) -> Optional[Future]:
+        # the future waiting for request_id, None for replies nobody waits for (duplicates, late replies)
+        with self.lock:
+            return self.pending.pop(request_id, None)
+
+
+class PeerConnectionPool:
+    # Idle TCP connections to peers, keyed by (ip, tcp port), so consecutive requests to the same
+    # peer skip the TCP handshake. The peer serves requests on a connection until it is closed.
+    def __init__(self, connect, size: int = POOL_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT):
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.reaper = None  # timer closing connections that stayed idle for idle_timeout
+
+    def acquire(self, address: Tuple[str, int]) -> Tuple[socket.socket, bool]:
+        # returns a connection and whether it was reused from the pool
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.get(address, [])
+            while connections:
+                sock, released_at = connections.pop()
+                if now - released_at < self.idle_timeout:
+                    return sock, True
+                sock.close()
+        return self.connect(*address), False
+
+    def release(self, address: Tuple[str, int], sock: socket.socket):
+        # only call this for connections with no unread response data
+        with self.lock:
+            connections = self.idle.setdefault(address, [])
+            if len(connections) < self.size:
+                connections.append((sock, time.monotonic()))
+                if self.reaper is None:
+                    self.schedule_reap(self.idle_timeout)
+                return
+        sock.close()
+
+    def idle_count(self) -> int:
+        # download threads add and remove peers while this runs
+        with self.lock:
+            return sum(len(connections) for connections in self.idle.values())
+
+    def schedule_reap(self, delay: float):
+        # call with the lock held
+        self.reaper = threading.Timer(delay, self.reap)
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def reap(self):
+        # Close connections idle for idle_timeout: the peer holds an upload worker for each of them
+        now = time.monotonic()
+        with self.lock:
+            self.reaper = None
+            for address, connections in list(self.idle.items()):
+                for sock, released_at in connections:
+                    if now - released_at >= self.idle_timeout:
+                        sock.close()
+                connections = [(sock, released_at) for sock, released_at in connections
+                               if now - released_at < self.idle_timeout]
+                if connections:
+                    self.idle[address] = connections
+                else:
+                    del self.idle[address]
+            if self.idle:
+                oldest = min(released_at for connections in self.idle.values() for _, released_at in connections)
+                self.schedule_reap(max(oldest + self.idle_timeout - now, 0.01))
+
+    def close(self):
+        with self.lock:
+            if self.reaper is not None:
+                self.reaper.cancel()
+                self.reaper = None
+            for connections in self.idle.values():
+                for sock, _ in connections:
+                    sock.close()
+            self.idle.clear()
+
+
+class PayloadReader:
+    # Reads the logical bytes of a response payload from a peer connection, either sent as is (STATUS_OK)
+    # or as frames (STATUS_FRAMED) that are decompressed on the way; counts what crossed the wire
+
+    def __init__(self, sock: socket.socket, framed: bool):
+        self.sock = sock
+        self.framed = framed
+        self.pending = memoryview(b"")  # decompressed bytes not handed out yet
+        self.raw_left = 0  # bytes of the current raw frame still on the connection
+        self.wire_bytes = 0
+
+    def readinto(self, view):
+        # Fill view completely
+        filled = 0
+        while filled < len(view):
+            if self.pending:
+                n = min(len(self.pending), len(view) - filled)
+                view[filled:filled + n] = self.pending[:n]
+                self.pending = self.pending[n:]
+            elif not self.framed or self.raw_left:
+                n = len(view) - filled if not self.framed else min(self.raw_left, len(view) - filled)
+                FileAppClient.recv_exact_into(self.sock, view[filled:filled + n])
+                self.wire_bytes += n
+                if self.framed:
+                    self.raw_left -= n
+            else:
+                codec_id, size = FRAME_HEADER.unpack(FileAppClient.recv_exact(self.sock, FRAME_HEADER.size))
+                self.wire_bytes += FRAME_HEADER.size
+                if size > COMPRESSION_FRAME_SIZE:
+                    raise ValueError(f"frame of {size} bytes from peer, at most {COMPRESSION_FRAME_SIZE} are allowed")
+                if codec_id == CODEC_RAW:
+                    self.raw_left = size
+                    continue
+                if codec_id not in DECOMPRESSORS:
+                    raise ValueError(f"unknown codec {codec_id} in response")
+                data = FileAppClient.recv_exact(self.sock, size)
+                self.wire_bytes += size
+                decompressor = DECOMPRESSORS[codec_id]()
+                try:
+                    self.pending = memoryview(decompressor.decompress(data, COMPRESSION_FRAME_SIZE))
+                except (zlib.error, lzma.LZMAError) as e:
+                    # a corrupt frame fails the request like any other protocol error
+                    raise ValueError(f"corrupt frame from peer: {e}") from e
+                if not decompressor.eof:
+                    # cut short, or it would expand beyond one frame (a decompression bomb)
+                    raise ValueError(f"frame from peer does not decompress to at most {COMPRESSION_FRAME_SIZE} bytes")
+                continue
+            filled += n
+
+    @property
+    def drained(self) -> bool:
+        # nothing of the current frame left unread, so the connection can take another request
+        return not self.pending and not self.raw_left
+
+
+class TokenBucket:
+    # Rate limiter: rate bytes per second, with bursts of up to SHAPING_BURST seconds worth of tokens.
+    # Waiters are served in arrival order; since every upload asks for one slice at a time, a bucket
+    # shared by several uploads hands out its bandwidth round-robin between them.
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(SHAPING_QUANTUM, rate * SHAPING_BURST)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting = collections.deque()
+        self.condition = threading.Condition()
+
+    def acquire(self, amount: int):
+        # block until amount bytes may be sent; a request larger than the bucket leaves it in debt
+        with self.condition:
+            ticket = object()
+            self.waiting.append(ticket)
+            while True:
+                if self.waiting[0] is ticket:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= min(amount, self.capacity):
+                        self.tokens -= amount
+                        self.waiting.popleft()
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait((min(amount, self.capacity) - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+
+
+class UploadShaper:
+    # The rate limits an upload connection is subject to: its own bucket and the client-wide one
+    def __init__(self, buckets: List[TokenBucket]):
+        self.buckets = buckets
+        self.throttled = 0.0  # seconds spent waiting for tokens
+
+    def acquire(self, amount: int):
+        start = time.perf_counter()
+        # the connection's own limit first, so a capped peer does not hold up the shared queue
+        for bucket in self.buckets:
+            bucket.acquire(amount)
+        self.throttled += time.perf_counter() - start
+
+
+class FileSegment:
+    # byte range [start, end) of a parallel download; pos is the next byte still missing.
+    # end can shrink while the segment is being downloaded when another peer steals its tail.
+    __slots__ = ("start", "end", "pos", "owner")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.owner = None
+
+    def remaining(self) -> int:
+        return self.end - self.pos
+
+
+class DownloadJournal:
+    # Sidecar file of a partial download. The first line is a JSON header (size, chunk size and a
+    # fingerprint of the sender's chunk hashes), every further line is the index of a chunk that was
+    # received, verified and written. A matching journal lets a later request resume where it stopped.
+    SUFFIX = ".journal"
+
+    def __init__(self, path: str, file_size: int, digests: List[bytes], done: set, resumed: bool):
+        self.path = path
+        self.file_size = file_size
+        self.digests = digests
+        self.done = done
+        self.resumed = resumed
+        self.lock = threading.Lock()
+        self.journal_file = open(path + self.SUFFIX, 'a')
+
+    @classmethod
+    def open(cls, path: str, file_size: int, digests: List[bytes]) -> "DownloadJournal":
+        journal_path = path + cls.SUFFIX
+        header = {
+            "size": file_size,
+            "chunk_size": CHUNK_SIZE,
+            "fingerprint": hashlib.sha256(b"".join(digests)).hexdigest(),
+        }
+
+        done = set()
+        resumed = False
+        # a file with more than one link shares its content with another file (a local copy of a
+        # duplicate download), writing into it would change that file too
+        if os.path.isfile(journal_path) and os.path.isfile(path) and os.stat(path).st_nlink == 1:
+            with open(journal_path) as f:
+                lines = f.read().split("\n")
+            try:
+                resumed = json.loads(lines[0]) == header
+            except ValueError:
+                resumed = False
+            if resumed:
+                # the last element is either empty or a line cut short by a crash
+                done = {int(line) for line in lines[1:-1] if line.isdigit()}
+
+        if resumed:
+            with open(path, 'r+b') as file:
+                file.truncate(file_size)
+        else:
+            # preallocate the output file and start a fresh journal, in a new file: truncating the old
+            # one would also truncate the files it is hardlinked to
+            if os.path.lexists(path):
+                os.remove(path)
+            with open(path, 'wb') as file:
+                file.truncate(file_size)
+            with open(journal_path, 'w') as f:
+                f.write(json.dumps(header) + "\n")
+
+        return cls(path, file_size, digests, done, resumed)
+
+    def missing_ranges(self) -> List[Tuple[int, int]]:
+        # byte ranges [start, end) made of consecutive chunks that are not verified yet
+        ranges = []
+        for index in range(len(self.digests)):
+            if index in self.done:
+                continue
+            start = index * CHUNK_SIZE
+            end = min(start + CHUNK_SIZE, self.file_size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def verify(self, index: int, data) -> bool:
+        return index < len(self.digests) and hashlib.sha256(data).digest() == self.digests[index]
+
+    def mark(self, first_index: int, count: int):
+        # record chunks that are already on disk
+        with self.lock:
+            self.journal_file.write("".join(f"{index}\n" for index in range(first_index, first_index + count)))
+            self.journal_file.flush()
+            self.done.update(range(first_index, first_index + count))
+
+    def close(self):
+        self.journal_file.close()
+
+    def complete(self):
+        self.close()
+        os.remove(self.path + self.SUFFIX)
 
 # this is client side
 
@@ -17,7 +971,12 @@ create socket(socket()) -> bind to port(bind()) -> send data(sendto()) -> receiv
 '''
 
 class FileAppClient:
-    def __init__(self, name, server_ip, server_port, client_udp_port, client_tcp_port):
+    def __init__(self, name, server_ip, server_port, client_udp_port, client_tcp_port,
+                 recv_buffer_size: int = RECV_BUFFER_SIZE, socket_rcvbuf: Optional[int] = None,
+                 upload_workers: int = UPLOAD_WORKERS, upload_queue: int = UPLOAD_QUEUE,
+                 tcp_backlog: int = TCP_BACKLOG, read_timeout: float = READ_TIMEOUT,
+                 busy_retry_ms: int = BUSY_RETRY_MS, codecs: Optional[List[str]] = None, reseed: bool = False,
+                 upload_limit: Optional[int] = None, peer_limit: Optional[int] = None):
         self.name = name
         self.server_ip = server_ip
         self.server_port = server_port
@@ -28,56 +987,175 @@ class FileAppClient:
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        # bind socket(ip) to a port
+        # bind socket(ip) to a port; a large receive buffer absorbs bursts of table fragments
         self.udp_socket.bind(('', client_udp_port))
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        self.assembler = FragmentAssembler()
 
-        # create client local table
+        # create client local table, kept in sync with the server's table version by deltas
         self.client_table = {}
+        self.table_version = 0
+        self.snapshot_requested_at = None
+
+        # filename -> owners, and lowercase client name -> client name, both kept in step with client_table
+        self.file_index = FileIndex()
+        self.client_names = {}
+
+        # content hash -> path of a local file with that content (offered or downloaded files)
+        self.local_content = {}
 
         self.dir = None
 
-    def register(self):
-        # create registration msg
-        message = f"REGISTER {self.name} {socket.gethostbyname(socket.gethostname())} {self.client_udp_port} {self.client_tcp_port}"
+        # download tuning: size of the recv_into buffer and the SO_RCVBUF of request sockets
+        if recv_buffer_size < CHUNK_SIZE:
+            raise ValueError(f"the receive buffer must hold at least one chunk ({CHUNK_SIZE} bytes)")
+        self.recv_buffer_size = recv_buffer_size
+        self.socket_rcvbuf = socket_rcvbuf
+
+        # codecs offered to peers for compressed downloads, in order of preference (none: raw transfers)
+        self.codecs = [codec for codec in codecs or [] if codec in CODECS]
 
-        # encode the msg and send to server
-        self.udp_socket.sendto(message.encode(), (self.server_ip, self.server_port))
+        # offer every downloaded file, so popular files gain owners and the upload load spreads out
+        self.reseed = reseed
 
-        # deal with server response
-        data, addr = self.udp_socket.recvfrom(1024)
-        response = data.decode().split(" ", 1)
+        # persistent connections to other peers, shared by all downloads
+        self.connection_pool = PeerConnectionPool(self.open_peer_connection)
 
-        if response[0] == "WELCOME":
+        # upload engine: a fixed pool of workers, plus a bounded number of connections waiting for one
+        self.upload_workers = upload_workers
+        self.upload_queue = upload_queue
+        self.tcp_backlog = tcp_backlog
+        self.read_timeout = read_timeout
+        self.busy_retry_ms = busy_retry_ms
+        self.upload_slots = threading.BoundedSemaphore(upload_workers + upload_queue)
+        # connections waiting for the next request after serving one, closed first when no worker is free
+        self.idle_connections = set()
+        self.idle_connections_lock = threading.Lock()
+
+        # upload rate limits in bytes per second: all uploads together, and each peer connection (None: no limit)
+        self.upload_limiter = TokenBucket(upload_limit) if upload_limit else None
+        self.peer_limit = peer_limit
+
+        # chunk hashes of served files, key: path, value: (size, mtime_ns, digests)
+        self.hash_cache = {}
+        self.hash_cache_lock = threading.Lock()
+
+        # counters, gauges and latency histograms of this client, see the "stats" command
+        self.metrics = Metrics()
+        self.metrics.gauge("table.version", lambda: self.table_version)
+        self.metrics.gauge("peer_connections.idle", self.connection_pool.idle_count)
+
+        # requests to the server (REGISTER, OFFER, DEREG, SEARCH, STATS), replies are read by run()
+        self.control = ControlChannel(self.udp_socket, (server_ip, server_port), self.metrics)
+
+        # set to stop the heartbeats started by register(); held while registering again after REREGISTER
+        self.heartbeat_stop = threading.Event()
+        self.reregistering = threading.Lock()
+
+        # offered files as of the last scan, key: path relative to dir, value: (size, mtime_ns),
+        # and the event that stops the watch() thread
+        self.offered_snapshot = {}
+        self.watch_stop = threading.Event()
+
+    def registration_message(self) -> bytes:
+        return f"REGISTER {self.name} {socket.gethostbyname(socket.gethostname())} {self.client_udp_port} {self.client_tcp_port}".encode()
+
+    def register(self):
+        # create registration msg; the reply is read by run(), which has to be running already
+        response = self.control.call(self.registration_message())
+
+        # run() installs the table of a WELCOME before handing the reply over
+        if response is None:
+            print(">>> [Error: Server not responding.]")
+            sys.exit(1)
+        elif response.startswith(b"WELCOME"):
             print(">>> [Welcome, You are registered.]")
-            self.update_client_table(response[1])
+            threading.Thread(target=self.heartbeat, daemon=True).start()
         else:
             print(">>> [Error: Registration failed.]")
             sys.exit(1)
 
+    def reregister(self):
+        # The server answered a heartbeat with REREGISTER: it dropped this client (offline for longer than
+        # its dead entry ttl) or restarted without its state. Register again and offer the same files.
+        if not self.reregistering.acquire(blocking=False):
+            return  # the signal repeats with every heartbeat while a registration is under way
+        try:
+            files = list(self.client_table.get(self.name, {}).get("files", []))
+            response = self.control.call(self.registration_message())
+            if response is None or not response.startswith(b"WELCOME"):
+                logger.warning("<Registering again failed, retrying with the next heartbeat>")
+                return
+            print("\n>>> [The server had lost this client, registered again.]", end="", flush=True)
+            files = [filename for filename in files if self.local_path(filename) is not None
+                     and os.path.isfile(self.local_path(filename))]
+            if files and not self.send_file_changes("OFFER", [self.offer_token(filename) for filename in files]):
+                logger.warning("<Offering the files again failed, offer them manually>")
+        finally:
+            self.reregistering.release()
+
+    def heartbeat(self):
+        # Tell the server this client is alive and which table version it has (a server that sees the
+        # same old version twice sends the whole table), until deregister()
+        while not self.heartbeat_stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.udp_socket.sendto(f"HEARTBEAT {self.name} {self.table_version}".encode(),
+                                       (self.server_ip, self.server_port))
+            except OSError:
+                break
+
     def print_client_table(self):
         print("\nClient Table:")
         for name, info in self.client_table.items():
             print(f"{name}: {info}")
         print("\n")
 
-    def update_client_table(self, table_data):
-        # Deserialize the table_data and update self.client_table
-        # After updating, send an ACK message to the server
-        self.client_table = self.deserialize_table(table_data)
+    def update_client_table(self, table_data: bytes):
+        # Deserialize the binary table_data and replace self.client_table
+        self.install_table(*self.deserialize_table(table_data))
+
+    def install_table(self, version: int, table: Dict[str, Dict[str, Union[str, int, List[str], bool]]]):
+        # Replace self.client_table, then send an ACK message to the server
+        self.table_version, self.client_table = version, table
+        self.file_index = FileIndex.from_table(self.client_table)
+        self.client_names = {name.lower(): name for name in self.client_table}
+        self.snapshot_requested_at = None
         self.udp_socket.sendto("ACK".encode(), (self.server_ip, self.server_port))
 
-    def deserialize_table(self, table_data: str) -> Dict[str, Dict[str, Union[str, int, List[str], bool]]]:
-        table = {}
-        for row in table_data.strip().split('\n'):
-            name, ip, udp_port, tcp_port, online, *files = row.split(' ')
-            table[name] = {
-                "ip": ip,
-                "udp_port": int(udp_port),
-                "tcp_port": int(tcp_port),
-                "files": files,
-                "online": bool(int(online))
-            }
-        return table
+    def apply_delta(self, delta_data: str) -> bool:
+        # Apply a DELTA ("<base version>\n<op>\n<op>...") to the table in place.
+        # Op number i moves the table from version base + i to base + i + 1.
+        # Returns True if the table changed.
+        header, *ops = delta_data.split("\n")
+        base_version = int(header)
+        if base_version > self.table_version:
+            # missed at least one delta, only a full snapshot can repair the table
+            self.request_snapshot()
+            return False
+        # skip ops that are already applied (duplicates, or a snapshot that overtook the delta)
+        ops = ops[self.table_version - base_version:]
+
+        changed = False
+        for op in ops:
+            op_name, name = apply_table_op(self.client_table, self.file_index, op)
+            if op_name == "JOIN":
+                self.client_names[name.lower()] = name
+            elif op_name == "REMOVE":
+                self.client_names.pop(name.lower(), None)
+            changed = changed or op_name != "BUMP"
+            self.table_version += 1
+        return changed
+
+    def request_snapshot(self):
+        # ask the server for the full table, at most once per second while a reply is outstanding
+        now = time.monotonic()
+        if self.snapshot_requested_at is not None and now - self.snapshot_requested_at < 1.0:
+            return
+        self.snapshot_requested_at = now
+        self.udp_socket.sendto(f"SNAPSHOT {self.name}".encode(), (self.server_ip, self.server_port))
+
+    def deserialize_table(self, table_data: bytes) -> Tuple[int, Dict[str, Dict[str, Union[str, int, List[str], bool]]]]:
+        return decode_table(table_data)
 
     def sigint_handler(self, signum, frame):
         self.handle_disconnect(silent=True)
@@ -135,134 +1213,947 @@ class FileAppClient:
                 self.handle_disconnect(silent=False)
                 break
     def list_files(self):
-        file_list = []
-        for name, info in self.client_table.items():
-            for file in info['files']:
-                file_list.append((file, name))
-
-        if not file_list:
+        # the index keeps filenames sorted, so listing needs no scan and sort of the whole table
+        if not self.file_index.sorted_names:
             print(">>> [No files available for download at the moment.]")
             return
 
         print("\nFile Offerings:")
-        file_list.sort(key=lambda x: (x[0], x[1]))
-        for file, name in file_list:
-            print(f"{file} - offered by {name}")
+        for file in self.file_index.sorted_names:
+            for name in sorted(self.file_index.lookup(file)):
+                print(f"{file} - offered by {name}")
+        print("\n")
+
+    def find_client(self, name: str) -> Optional[str]:
+        # case-insensitive lookup of a client name
+        return self.client_names.get(name.lower())
+
+    def search(self, pattern: str, page: int = 0):
+        # Ask the server which online clients offer files matching pattern, without using the local table
+        response = self.control.call(f"SEARCH {pattern} {page}".encode())
+        if response is None or not response.startswith(b"RESULTS "):
+            print(">>> [No answer from the server, please try again later.]")
+            return
+
+        header, *rows = response[len(b"RESULTS "):].decode().split("\n")
+        page, pages, total = (int(value) for value in header.split(" "))
+        if not total:
+            print(f">>> [No files matching '{pattern}'.]")
+            return
+        print(f"\nSearch results for '{pattern}' (page {page + 1} of {pages}, {total} files):")
+        for row in rows:
+            filename, _, owners = row.partition(" ")
+            print(f"{filename} - offered by {owners.replace(',', ', ')}")
         print("\n")
 
-    def request_file(self, filename: str, target_client: str):
+    def stats(self, server: bool = False):
+        # Print this client's metrics, or with server=True the server's (STATS request)
+        if not server:
+            print(json.dumps(self.metrics.snapshot(), indent=2))
+            return
+        response = self.control.call(b"STATS")
+        if response is None or not response.startswith(b"STATS "):
+            print(">>> [No answer from the server, please try again later.]")
+            return
+        print(json.dumps(json.loads(response[len(b"STATS "):]), indent=2))
+
+    def request_file(self, filename: str, target_client: Optional[str] = None):
+        if target_client is None:
+            self.request_file_any(filename)
+            return
+
         target_client = target_client.lower()  # Convert the provided client name to lowercase
 
         # Search for the target client in the client_table using a case-insensitive comparison
-        matching_client = None
-        for name in self.client_table:
-            if name.lower() == target_client:
-                matching_client = name
-                break
+        matching_client = self.find_client(target_client)
 
         if not matching_client:
             print(f">>> Invalid Request: Client '{target_client}' does not exist in the client table.")
             return
 
-        if filename not in self.client_table[matching_client]['files']:
+        if matching_client not in self.file_index.lookup(filename):
             print(f">>> Invalid Request: File '{filename}' is not available from client '{matching_client}'.")
             return
 
-        file_owner = self.client_table[matching_client]
-        ip = file_owner["ip"]
-        tcp_port = file_owner["tcp_port"]
+        self.download(filename, [matching_client])
 
+    def request_file_any(self, filename: str):
+        # Download from the online owner with the lowest rtt * (1 + load), trying the next one if it fails
+        owners = [name for name in sorted(self.file_index.lookup(filename))
+                  if self.client_table[name]["online"] and name != self.name]
+        if not owners:
+            print(f">>> Invalid Request: File '{filename}' is not offered by any online client.")
+            return
+
+        # every PING holds an upload worker of the owner, so only a sample of a popular file's owners is asked
+        random.shuffle(owners)
+        sampled, rest = owners[:PING_SAMPLE], owners[PING_SAMPLE:]
+        pings = {}
+        threads = [threading.Thread(target=lambda name=name: pings.update({name: self.score_owner(name)}))
+                   for name in sampled]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        answered = sorted((name for name in sampled if pings[name] is not None), key=lambda name: pings[name][0])
+        # owners that did not answer the PING are tried last, after the ones that were not asked
+        ranked = answered + rest + [name for name in sampled if pings[name] is None]
+        # the download reuses the connection to the selected owner, the others are closed to free their workers
+        for name in answered:
+            sock = pings[name][1]
+            if name == ranked[0]:
+                info = self.client_table[name]
+                self.connection_pool.release((info["ip"], info["tcp_port"]), sock)
+            else:
+                sock.close()
+        for name in ranked:
+            if pings.get(name) is not None:
+                logger.info(f"<Selected '{name}' for '{filename}' (score {pings[name][0] * 1000:.2f} ms)>")
+            self.metrics.incr("download.owner_selected")
+            if self.download(filename, [name]):
+                return
+
+    def score_owner(self, name: str) -> Optional[Tuple[float, socket.socket]]:
+        # Round trip time of a PING to the owner, weighted by its advertised upload load, and the connection
+        # that answered it; None if it did not answer
+        info = self.client_table[name]
+        address = (info["ip"], info["tcp_port"])
+        try:
+            sock, _ = self.connection_pool.acquire(address)
+        except OSError:
+            return None
+        try:
+            sock.settimeout(PING_TIMEOUT)
+            start = time.perf_counter()
+            sock.sendall(b"PING\n")
+            status, load, capacity = RESPONSE_HEADER.unpack(self.recv_exact(sock, RESPONSE_HEADER.size))
+            rtt = time.perf_counter() - start
+        except OSError:
+            sock.close()
+            return None
+        if status != STATUS_OK:
+            sock.close()  # busy: the peer closes the connection
+            return None
+        sock.settimeout(None)
+        return rtt * (1 + load / max(capacity, 1)), sock
+
+    def open_peer_connection(self, ip: str, tcp_port: int) -> socket.socket:
         # Create a new TCP socket for each request
-        request_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.socket_rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_rcvbuf)
+        # request lines are tiny and pipelined, send them right away
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect((ip, tcp_port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def peer_request(self, info, request: str) -> Tuple[socket.socket, Tuple[int, int, int]]:
+        # Send one request line over a pooled connection and read the response header (status, file size, length).
+        # A pooled connection may have been closed by the peer in the meantime, so a failure on a reused
+        # connection is retried once on a fresh one.
+        address = (info["ip"], info["tcp_port"])
+        while True:
+            sock, reused = self.connection_pool.acquire(address)
+            try:
+                sock.sendall(f"{request}\n".encode())
+                return sock, RESPONSE_HEADER.unpack(self.recv_exact(sock, RESPONSE_HEADER.size))
+            except OSError:
+                sock.close()
+                if not reused:
+                    raise
+
+    def request_hashes(self, info, filename: str) -> Tuple[int, int, List[bytes]]:
+        # Ask the owner for the per-chunk hashes of filename, returns (status, file size, digests)
+        sock, (status, file_size, length) = self.peer_request(info, f"HASHES {filename}")
+        try:
+            data = self.recv_exact(sock, length)
+        except OSError:
+            sock.close()
+            raise
+        if status == STATUS_BUSY:
+            sock.close()  # the peer closes busy connections
+        else:
+            self.connection_pool.release((info["ip"], info["tcp_port"]), sock)
+        return status, file_size, [data[i:i + DIGEST_SIZE] for i in range(0, length, DIGEST_SIZE)]
+
+    def request_file_parallel(self, filename: str):
+        owners = [name for name in sorted(self.file_index.lookup(filename))
+                  if self.client_table[name]["online"] and name != self.name]
+        if not owners:
+            print(f">>> Invalid Request: File '{filename}' is not offered by any online client.")
+            return
+
+        self.download(filename, owners)
+
+    def download(self, filename: str, owners: List[str]) -> bool:
+        # Download filename from the given owners at once, one worker thread per owner.
+        # The missing part of the file is split into segments that workers pull from a shared queue;
+        # a worker that runs out of work steals the second half of the largest segment still in flight,
+        # so slow peers end up serving less of the file. Every chunk is checked against the hashes
+        # of the sender and recorded in a journal, so an interrupted download resumes where it stopped.
+        owners = list(owners)
+        path = self.local_path(filename)
+        if path is None:
+            print(f">>> [Error: '{filename}' is not a valid name for a file in {self.dir}.]")
+            return False
+
+        # identical content may already be on disk, under this or another name
+        advertised = [self.client_table[name].get("hashes", {}).get(filename) for name in owners]
+        if self.copy_from_local(filename, next((digest for digest in advertised if digest), None)):
+            if self.reseed:
+                self.offer(filename)
+            return True
+
+        # Ask the first owner that answers for the file size and chunk hashes
+        digests = None
+        for name in list(owners):
+            info = self.client_table[name]
+            try:
+                for _ in range(BUSY_RETRIES):
+                    status, file_size, digests = self.request_hashes(info, filename)
+                    if status != STATUS_BUSY:
+                        break
+                    time.sleep(file_size / 1000)
+            except OSError as e:
+                logger.warning(f"<Skipping '{name}': {e}>")
+                owners.remove(name)
+                continue
+            if status == STATUS_OK:
+                break
+            if status == STATUS_BUSY:
+                logger.warning(f"<Skipping '{name}': peer busy>")
+                owners.remove(name)
+                digests = None
+                continue
+            print(f">>> [Error: File '{filename}' not found on client '{name}'.]")
+            owners.remove(name)
+            digests = None
+        if digests is None:
+            print(f">>> [Error: No owner of '{filename}' could serve it.]")
+            self.metrics.incr("download.failed")
+            return False
+        logger.debug(f"Received file size: {file_size}")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        journal = DownloadJournal.open(path, file_size, digests)
+        missing = journal.missing_ranges()
+        missing_size = sum(end - start for start, end in missing)
+        if journal.resumed:
+            logger.info(f"<Resuming '{filename}': {file_size - missing_size} of {file_size} bytes already verified>")
+
+        # a single owner takes every missing range in one piece, several owners share smaller segments
+        if len(owners) == 1:
+            segment_size = max(file_size, CHUNK_SIZE)
+        else:
+            segment_size = max(MIN_SEGMENT_SIZE, -(-missing_size // (len(owners) * 4 * CHUNK_SIZE)) * CHUNK_SIZE)
+        pending = [FileSegment(seg_start, min(seg_start + segment_size, end))
+                   for start, end in missing for seg_start in range(start, end, segment_size)]
+        pending.reverse()  # pop() hands segments out from the start of the file
+        active = []
+        lock = threading.Condition()
+        served = {name: 0 for name in owners}
+        traffic = {"wire": 0, "logical": 0}
+
+        def next_segment(name):
+            with lock:
+                while True:
+                    if pending:
+                        segment = pending.pop()
+                        break
+                    # work stealing: split the largest segment another peer is still downloading
+                    victims = [s for s in active if s.owner != name and s.remaining() >= 2 * CHUNK_SIZE]
+                    if victims:
+                        victim = max(victims, key=FileSegment.remaining)
+                        middle = victim.pos + victim.remaining() // (2 * CHUNK_SIZE) * CHUNK_SIZE
+                        segment = FileSegment(middle, victim.end)
+                        victim.end = middle
+                        break
+                    if not active:
+                        return None
+                    # nothing to take right now, but a failing peer may still hand its segment back
+                    lock.wait(0.1)
+                segment.owner = name
+                active.append(segment)
+                return segment
+
+        def worker(name):
+            info = self.client_table[name]
+            # a whole number of chunks, so every chunk can be verified before it is written
+            buffer = bytearray(self.recv_buffer_size // CHUNK_SIZE * CHUNK_SIZE)
+            view = memoryview(buffer)
+            failures = 0
+            busy = 0
+            with open(path, 'r+b') as file:
+                while True:
+                    segment = next_segment(name)
+                    if segment is None:
+                        return
+                    try:
+                        served[name] += self.fetch_segment(info, filename, segment, file, view, lock, journal, traffic)
+                        failures = 0
+                        busy = 0
+                    except PeerBusy as e:
+                        # hand the segment back so an idle peer can take it, then wait as the peer asked
+                        busy += 1
+                        self.metrics.incr("download.peer_busy")
+                        with lock:
+                            active.remove(segment)
+                            pending.append(segment)
+                            lock.notify_all()
+                        if busy > BUSY_RETRIES:
+                            logger.warning(f"<Peer '{name}' stayed busy>")
+                            return
+                        time.sleep(e.retry_after)
+                        continue
+                    except (OSError, ValueError) as e:
+                        failures += 1
+                        self.metrics.incr("download.peer_failures")
+                        logger.warning(f"<Peer '{name}' failed: {e}>")
+                        with lock:
+                            active.remove(segment)
+                            if segment.remaining() > 0:
+                                pending.append(segment)
+                            lock.notify_all()
+                        if failures > DOWNLOAD_RETRIES:
+                            return
+                        # the peer may just be restarting: back off, then resume from the first missing chunk
+                        time.sleep(RETRY_BACKOFF * 2 ** (failures - 1))
+                        continue
+                    except Exception:
+                        # a bug must not strand the segment in active, other workers would wait for it forever
+                        self.metrics.incr("download.peer_failures")
+                        logger.exception(f"<Peer '{name}' failed unexpectedly>")
+                        with lock:
+                            active.remove(segment)
+                            if segment.remaining() > 0:
+                                pending.append(segment)
+                            lock.notify_all()
+                        return
+                    with lock:
+                        active.remove(segment)
+                        lock.notify_all()
+
+        start_time = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(name,), daemon=True) for name in owners]
+        self.metrics.add_gauge("downloads.active", 1)
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.metrics.add_gauge("downloads.active", -1)
+        elapsed = time.perf_counter() - start_time
+
+        if pending or active:
+            journal.close()
+            print(f">>> [Error: Download of '{filename}' incomplete, request it again to resume.]")
+            self.metrics.incr("download.failed")
+            return False
 
+        journal.complete()
+        self.remember_download(path, digests)
+        self.metrics.record_transfer("download", filename, missing_size, traffic["wire"], elapsed)
+        logger.info(f"<File transfer complete: {format_throughput(missing_size, elapsed)}, "
+                    f"{format_wire(traffic['wire'], traffic['logical'])}>")
+        if len(owners) > 1:
+            for name, count in served.items():
+                logger.info(f"  {name}: {count} bytes")
+        if self.reseed:
+            self.offer(filename)
+        return True
+
+    def remember_download(self, path: str, digests: List[bytes]):
+        # remember the content, later requests for it (under any name) are served from disk
+        stat = os.stat(path)
+        with self.hash_cache_lock:
+            self.hash_cache[path] = (stat.st_size, stat.st_mtime_ns, digests)
+        self.local_content[content_hash(digests)] = path
+
+    def local_content_hash(self, path: str) -> str:
+        return content_hash(self.get_chunk_hashes(path)[1])
+
+    def copy_from_local(self, filename: str, digest: Optional[str]) -> bool:
+        # Satisfy a download from a local file with the same content hash instead of the network:
+        # nothing to do if the destination already has it, otherwise hardlink (or copy) the local file
+        if digest is None:
+            return False
+        path = self.local_path(filename)
+        if os.path.isfile(path) and self.local_content_hash(path) == digest:
+            logger.info(f"<'{filename}' is already present locally, skipping download>")
+            self.metrics.incr("download.local_copies")
+            return True
+
+        source = self.local_content.get(digest)
+        if source is None or not os.path.isfile(source) or self.local_content_hash(source) != digest:
+            return False
+        temp_path = path + ".tmp"
         try:
-            # Establish a TCP connection with the file owner
-            request_tcp_socket.connect((ip, tcp_port))
-            print("<TCP connection established with file owner>")
-
-            # Send a request for the file
-            request_tcp_socket.sendall(f"REQUEST {filename}".encode())
-            print("Sent file request")
-
-            # Receive the file size
-            file_size_str = request_tcp_socket.recv(1024).decode()
-            print(f"Received file size string: {file_size_str}")
-            file_size = int(file_size_str)
-            print(f"Received file size: {file_size}")
-            # Receive the file
-            with open(os.path.join(self.dir, filename), 'wb') as file:
-                received_size = 0
-                while received_size < file_size:
-                    data = request_tcp_socket.recv(1024)
-                    received_size += len(data)
-                    file.write(data)
-
-            print("<File transfer complete>")
-
-        except Exception as e:
-            print(f">>> Error requesting file: {str(e)}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            try:
+                os.link(source, temp_path)
+            except OSError:
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"<Could not copy local file '{source}': {e}>")
+            return False
+        logger.info(f"<'{filename}' has the same content as local file '{source}', copied instead of downloaded>")
+        self.metrics.incr("download.local_copies")
+        return True
+
+    def codec_option(self) -> str:
+        # suffix of REQUEST lines advertising the codecs this client accepts
+        return f" codecs={','.join(self.codecs)}" if self.codecs else ""
+
+    def fetch_segment(self, info, filename: str, segment: FileSegment, file, view, lock, journal: DownloadJournal,
+                      traffic: Dict[str, int]) -> int:
+        # Download one segment into its place in the preallocated file, returns the bytes it contributed.
+        # Wire and logical bytes received are added to traffic.
+        with lock:
+            start, end = segment.pos, segment.end
+        sock, (status, retry_after, length) = self.peer_request(
+            info, f"REQUEST {filename} {start} {end - start}{self.codec_option()}")
+        reader = PayloadReader(sock, status == STATUS_FRAMED)
+        received = 0
+        try:
+            if status == STATUS_BUSY:
+                raise PeerBusy(retry_after / 1000)
+            if status not in (STATUS_OK, STATUS_FRAMED):
+                raise ValueError(f"file '{filename}' not available")
+
+            pos = start
+            while received < length:
+                # fill the buffer before touching the file, but never past what is left of the range
+                want = min(len(view), length - received)
+                reader.readinto(view[:want])
+                received += want
+
+                # segments start on chunk boundaries, so the buffer holds whole chunks (the last may be short)
+                first_index = pos // CHUNK_SIZE
+                for offset in range(0, want, CHUNK_SIZE):
+                    if not journal.verify(first_index + offset // CHUNK_SIZE, view[offset:min(offset + CHUNK_SIZE, want)]):
+                        raise ValueError(f"chunk {first_index + offset // CHUNK_SIZE} of '{filename}' failed verification")
+
+                with lock:
+                    # the tail of this segment may have been stolen in the meantime; the write happens
+                    # under the lock so a thief never splits at a position that is not on disk yet
+                    commit = max(0, min(want, segment.end - pos))
+                    if commit:
+                        file.seek(pos)
+                        file.write(view[:commit])
+                        file.flush()
+                    pos += commit
+                    segment.pos = pos
+                    finished = pos >= segment.end
+                if commit:
+                    journal.mark(first_index, -(-commit // CHUNK_SIZE))
+                if finished:
+                    break
+            if pos < segment.end:
+                raise ConnectionError("range ended early")
+            return pos - start
         finally:
-            request_tcp_socket.close()
+            with lock:
+                traffic["wire"] += reader.wire_bytes
+                traffic["logical"] += received
+            # a stolen segment leaves unread bytes on the connection, so only a fully read one is reused
+            if status in (STATUS_OK, STATUS_FRAMED) and received == length and reader.drained:
+                self.connection_pool.release((info["ip"], info["tcp_port"]), sock)
+            else:
+                sock.close()
+
+    def request_batch(self, target_client: str, *patterns: str):
+        # Download many files from one peer over a single persistent connection. Filenames may be
+        # glob patterns matched against the peer's files. Every file is asked for with a HASHES and a
+        # REQUEST line, up to PIPELINE_DEPTH files in flight at once; responses come back in request order,
+        # each framed by its header, and every chunk is verified and journaled like in download().
+        matching_client = self.find_client(target_client)
+        if not matching_client:
+            print(f">>> Invalid Request: Client '{target_client}' does not exist in the client table.")
+            return
+
+        info = self.client_table[matching_client]
+        filenames = []
+        for pattern in patterns:
+            for filename in self.file_index.search(pattern) if any(c in pattern for c in "*?[") else [pattern]:
+                if (matching_client in self.file_index.lookup(filename) and filename not in filenames
+                        and self.local_path(filename) is not None):
+                    filenames.append(filename)
+        if not filenames:
+            print(f">>> Invalid Request: No file matching {' '.join(patterns)} is available from client '{matching_client}'.")
+            return
+        filenames = [filename for filename in filenames
+                     if not self.copy_from_local(filename, info.get("hashes", {}).get(filename))]
+        if not filenames:
+            return
+
+        address = (info["ip"], info["tcp_port"])
+        # a whole number of chunks, so every chunk can be verified before it is written
+        buffer = bytearray(self.recv_buffer_size // CHUNK_SIZE * CHUNK_SIZE)
+        view = memoryview(buffer)
+        remaining = list(filenames)
+        failures = 0
+        received_files = []
+        received_bytes = 0
+        wire_bytes = 0
+        start_time = time.perf_counter()
+
+        while remaining:
+            sock, _ = self.connection_pool.acquire(address)
+            in_flight = 0
+            try:
+                while remaining:
+                    # keep the pipeline full
+                    while in_flight < min(PIPELINE_DEPTH, len(remaining)):
+                        filename = remaining[in_flight]
+                        sock.sendall(f"HASHES {filename}\nREQUEST {filename}{self.codec_option()}\n".encode())
+                        in_flight += 1
+
+                    filename = remaining[0]
+                    complete, received, wire = self.receive_batch_file(sock, matching_client, filename, view)
+                    remaining.pop(0)
+                    in_flight -= 1
+                    received_bytes += received
+                    wire_bytes += wire
+                    if complete:
+                        received_files.append(filename)
+                    failures = 0
+                self.connection_pool.release(address, sock)
+            except PeerBusy as e:
+                sock.close()
+                failures += 1
+                if failures > BUSY_RETRIES:
+                    break
+                time.sleep(e.retry_after)
+            except (OSError, ValueError) as e:
+                # reconnect and re-request everything that was not answered yet; the file that was
+                # being received resumes from its journal
+                sock.close()
+                failures += 1
+                self.metrics.incr("download.peer_failures")
+                logger.warning(f"<Peer '{matching_client}' failed: {e}>")
+                if failures > DOWNLOAD_RETRIES:
+                    break
+                time.sleep(RETRY_BACKOFF * 2 ** (failures - 1))
+
+        elapsed = time.perf_counter() - start_time
+        if len(received_files) < len(filenames):
+            print(f">>> [Error: {len(filenames) - len(received_files)} of {len(filenames)} files could not be downloaded.]")
+        self.metrics.record_transfer("batch", f"{len(received_files)} files", received_bytes, wire_bytes, elapsed)
+        logger.info(f"<Batch transfer complete: {len(received_files)} files, {format_throughput(received_bytes, elapsed)}, "
+                    f"{format_wire(wire_bytes, received_bytes)}>")
+        if self.reseed and received_files:
+            self.offer(*received_files)
+
+    def receive_batch_file(self, sock, owner: str, filename: str, view) -> Tuple[bool, int, int]:
+        # Read the HASHES and REQUEST responses of one batch file and write it through a DownloadJournal,
+        # returns (complete, logical bytes, wire bytes). The whole response is read even if a chunk fails
+        # verification, so the connection stays usable for the next file; the partial file keeps its
+        # journal, which hides it from offer --all and lets a later single-file request resume it.
+        status, file_size, length = RESPONSE_HEADER.unpack(self.recv_exact(sock, RESPONSE_HEADER.size))
+        if status == STATUS_BUSY:
+            raise PeerBusy(file_size / 1000)
+        digest_data = self.recv_exact(sock, length)
+        request_status, size, length = RESPONSE_HEADER.unpack(self.recv_exact(sock, RESPONSE_HEADER.size))
+        reader = PayloadReader(sock, request_status == STATUS_FRAMED)
+        if status != STATUS_OK or request_status not in (STATUS_OK, STATUS_FRAMED):
+            print(f">>> [Error: File '{filename}' not found on client '{owner}'.]")
+            received = 0
+            while request_status in (STATUS_OK, STATUS_FRAMED) and received < length:
+                want = min(len(view), length - received)
+                reader.readinto(view[:want])
+                received += want
+            return False, 0, reader.wire_bytes
+
+        digests = [digest_data[i:i + DIGEST_SIZE] for i in range(0, len(digest_data), DIGEST_SIZE)]
+        path = self.local_path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        journal = DownloadJournal.open(path, file_size, digests)
+        # the file may have changed between the two responses
+        valid = size == file_size and length == file_size
+        received = 0
+        with open(path, 'r+b') as file:
+            while received < length:
+                want = min(len(view), length - received)
+                reader.readinto(view[:want])
+                first_index = received // CHUNK_SIZE
+                valid = valid and all(journal.verify(first_index + offset // CHUNK_SIZE,
+                                                     view[offset:min(offset + CHUNK_SIZE, want)])
+                                      for offset in range(0, want, CHUNK_SIZE))
+                if valid:
+                    file.seek(received)
+                    file.write(view[:want])
+                    file.flush()
+                    journal.mark(first_index, -(-want // CHUNK_SIZE))
+                received += want
+        if not valid:
+            journal.close()
+            self.metrics.incr("download.failed")
+            print(f">>> [Error: '{filename}' from '{owner}' failed verification, request it again.]")
+            return False, received, reader.wire_bytes
+        journal.complete()
+        self.remember_download(path, digests)
+        return True, received, reader.wire_bytes
+
+    @staticmethod
+    def recv_exact_into(sock, view):
+        # Fill view completely from sock, raises if the peer closes the connection first
+        received = 0
+        while received < len(view):
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("connection closed by peer")
+            received += n
+
+    @classmethod
+    def recv_exact(cls, sock, size: int) -> bytes:
+        # Read exactly size bytes, used for the protocol headers
+        data = bytearray(size)
+        cls.recv_exact_into(sock, memoryview(data))
+        return bytes(data)
 
     def start_tcp_server(self, port):
         tcp_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         tcp_server_socket.bind(('', port))
-        tcp_server_socket.listen(5)
+        tcp_server_socket.listen(self.tcp_backlog)
 
-        print(f"TCP server started at :{port}")
+        logger.info(f"TCP server started at :{port}")
+        if self.upload_limiter or self.peer_limit:
+            logger.info(f"<Upload limits: {self.upload_limiter.rate if self.upload_limiter else 'none'} bytes/s in total, "
+                        f"{self.peer_limit or 'none'} bytes/s per connection>")
+
+        # a fixed pool of upload workers instead of one thread per connection;
+        # connections beyond the workers wait in the pool's queue, up to upload_queue of them
+        executor = ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="upload")
+        # connections that found no free slot, so the accept loop never waits on a handover or a rejection
+        admission = ThreadPoolExecutor(max_workers=ADMISSION_WORKERS, thread_name_prefix="admission")
 
         while True:
             conn, addr = tcp_server_socket.accept()
-            print(f"<TCP Connection established with {addr[0]}:{addr[1]}>")
+            logger.debug(f"<TCP Connection established with {addr[0]}:{addr[1]}>")
+            self.metrics.incr("peer.connections")
 
-            request_handler = threading.Thread(target=self.handle_incoming_request, args=(conn, addr))
+            if self.upload_slots.acquire(blocking=False):
+                self.metrics.add_gauge("peer.connections_waiting", 1)
+                executor.submit(self.serve_connection, conn, addr)
+            else:
+                admission.submit(self.admit_or_reject, executor, conn, addr)
 
-            request_handler.start()
+    def admit_or_reject(self, executor: ThreadPoolExecutor, conn, addr):
+        # an idle keep-alive connection gives its worker to the new one, its peer reconnects when it needs to
+        if self.close_idle_connection() and self.upload_slots.acquire(timeout=IDLE_HANDOVER_TIMEOUT):
+            self.metrics.add_gauge("peer.connections_waiting", 1)
+            executor.submit(self.serve_connection, conn, addr)
+        else:
+            self.reject_busy(conn, addr)
+
+    def close_idle_connection(self) -> bool:
+        # Shut one idle connection down, its worker returns from readline and frees its upload slot
+        with self.idle_connections_lock:
+            if not self.idle_connections:
+                return False
+            conn = self.idle_connections.pop()
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.metrics.incr("peer.idle_closed")
+        return True
+
+    def reject_busy(self, conn, addr):
+        # Tell the peer to come back later instead of letting it hang in the queue
+        try:
+            # read the request first, closing a socket with unread data would reset the connection
+            conn.settimeout(0.1)
+            conn.recv(1024)
+            conn.sendall(RESPONSE_HEADER.pack(STATUS_BUSY, self.busy_retry_ms, 0))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+        self.metrics.incr("peer.rejected_busy")
+        logger.warning(f"<Busy: rejected {addr[0]}:{addr[1]}, retry after {self.busy_retry_ms} ms>")
 
-    def handle_incoming_request(self, conn, addr):
-        received_message = conn.recv(1024).decode()
-        print(f"Received request: {received_message}")
+    def serve_connection(self, conn, addr):
+        self.metrics.add_gauge("peer.connections_waiting", -1)
+        self.metrics.add_gauge("peer.connections_served", 1)
+        try:
+            # a stalled peer can hold a worker for at most read_timeout seconds per operation
+            conn.settimeout(self.read_timeout)
+            # headers are small writes followed by the payload, don't let Nagle hold them back
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.handle_incoming_request(conn, addr)
+        except (OSError, ValueError) as e:
+            logger.warning(f"<Error serving {addr[0]}:{addr[1]}: {e}>")
+            conn.close()
+        finally:
+            self.metrics.add_gauge("peer.connections_served", -1)
+            self.upload_slots.release()
 
-        # Extract the filename from the received message
-        command, filename = received_message.split(" ", 1)
+    def upload_shaper(self) -> Optional[UploadShaper]:
+        # rate limits for a new peer connection, None if uploads are not limited
+        buckets = [TokenBucket(self.peer_limit)] if self.peer_limit else []
+        if self.upload_limiter is not None:
+            buckets.append(self.upload_limiter)
+        return UploadShaper(buckets) if buckets else None
 
-        file_path = os.path.join(self.dir, filename)
-        print(f"<Sending file '{filename}' to {addr[0]}:{addr[1]}>")
+    def handle_incoming_request(self, conn, addr):
+        # Serve request lines on the connection until the peer closes it, so a peer can reuse
+        # one connection for many requests and pipeline them
+        shaper = self.upload_shaper()
+        reader = conn.makefile("rb")
+        served = False
+        try:
+            while True:
+                if served and not self.has_buffered_request(conn, reader):
+                    # waiting for the peer to reuse the connection, it may be closed for a new one
+                    with self.idle_connections_lock:
+                        self.idle_connections.add(conn)
+                conn.settimeout(KEEPALIVE_TIMEOUT)
+                try:
+                    line = reader.readline(1024)
+                finally:
+                    with self.idle_connections_lock:
+                        self.idle_connections.discard(conn)
+                if not line:
+                    break
+                conn.settimeout(self.read_timeout)
+                self.handle_request(conn, addr, line.decode().strip(), shaper)
+                served = True
+        except socket.timeout:
+            logger.debug(f"<Idle TCP connection with {addr[0]}:{addr[1]} timed out>")
+        finally:
+            reader.close()
+            conn.close()
+            logger.debug(f"<TCP Connection closed with {addr[0]}:{addr[1]}>")
+
+    @staticmethod
+    def has_buffered_request(conn, reader) -> bool:
+        # whether a pipelined request already arrived, without waiting for one
+        conn.setblocking(False)
+        return bool(reader.peek(1))
+
+    def handle_request(self, conn, addr, received_message: str, shaper: Optional[UploadShaper] = None):
+        logger.debug(f"Received request: {received_message}")
+
+        if received_message == "PING":
+            # PONG: an OK header with the current load (uploads sending or waiting for a worker) and capacity
+            load = self.metrics.gauges.get("uploads.active", 0) + self.metrics.gauges.get("peer.connections_waiting", 0)
+            conn.sendall(RESPONSE_HEADER.pack(STATUS_OK, load, self.upload_workers))
+            return
 
-        if os.path.isfile(file_path):
+        # Extract the filename, the optional byte range and options from the received message:
+        # REQUEST <filename> [<offset> <length>] [codecs=<codec>,...] or HASHES <filename>
+        command, filename, *rest = received_message.split(" ")
+        byte_range = [token for token in rest if "=" not in token]
+        options = dict(token.split("=", 1) for token in rest if "=" in token)
+
+        # nested paths are served, but nothing outside the shared directory
+        file_path = self.local_path(filename)
+        self.metrics.incr(f"peer.requests.{'HASHES' if command == 'HASHES' else 'REQUEST'}")
+
+        if command == "HASHES":
+            if file_path is not None and os.path.isfile(file_path):
+                file_size, digests = self.get_chunk_hashes(file_path)
+                conn.sendall(RESPONSE_HEADER.pack(STATUS_OK, file_size, len(digests) * DIGEST_SIZE) + b"".join(digests))
+                logger.debug(f"<Sent {len(digests)} chunk hashes of '{filename}' to {addr[0]}:{addr[1]}>")
+            else:
+                conn.sendall(RESPONSE_HEADER.pack(STATUS_NOT_FOUND, 0, 0))
+                self.metrics.incr("peer.not_found")
+                logger.warning(f"<Error: File '{filename}' not found>")
+        elif len(byte_range) not in (0, 2) or not all(token.isdecimal() for token in byte_range):
+            # the range is two non-negative integers or nothing
+            conn.sendall(RESPONSE_HEADER.pack(STATUS_NOT_FOUND, 0, 0))
+            self.metrics.incr("peer.bad_requests")
+            logger.warning(f"<Error: Invalid byte range {' '.join(byte_range)} for '{filename}'>")
+        elif file_path is not None and os.path.isfile(file_path):
+            logger.debug(f"<Sending file '{filename}' to {addr[0]}:{addr[1]}>")
             file_size = os.path.getsize(file_path)
-            print(f"File size: {file_size}")
+            logger.debug(f"File size: {file_size}")
 
-            conn.send(str(file_size).encode())
-            print(f"Sent file size: {file_size}")
+            if byte_range:
+                offset = min(int(byte_range[0]), file_size)
+                length = min(int(byte_range[1]), file_size - offset)
+            else:
+                offset, length = 0, file_size
 
-            with open(file_path, "rb") as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    conn.sendall(data)
+            # the first codec of the requester's list that this side knows, if any
+            codec = next((c for c in options.get("codecs", "").split(",") if c in CODECS), None)
+            conn.sendall(RESPONSE_HEADER.pack(STATUS_FRAMED if codec else STATUS_OK, file_size, length))
+            logger.debug(f"Sent file size: {file_size}")
 
-            print(f"<File '{filename}' sent>")
+            start_time = time.perf_counter()
+            throttled = shaper.throttled if shaper else 0.0
+            self.metrics.add_gauge("uploads.active", 1)
+            try:
+                with open(file_path, "rb") as f:
+                    if codec:
+                        sent, wire = self.send_file_frames(conn, f, offset, length, codec, shaper)
+                    else:
+                        sent = wire = self.send_file_data(conn, f, offset, length, shaper)
+            finally:
+                self.metrics.add_gauge("uploads.active", -1)
+            elapsed = time.perf_counter() - start_time
+            throttled = shaper.throttled - throttled if shaper else 0.0
+
+            self.metrics.record_transfer("upload", filename, sent, wire, elapsed, throttled)
+            logger.info(f"<File '{filename}' sent: {format_throughput(sent, elapsed)}, {format_wire(wire, sent)}"
+                        + (f", throttled {throttled:.3f}s>" if shaper else ">"))
         else:
-            print(f"<Error: File '{filename}' not found>")
-
-        conn.close()
-        print(f"<TCP Connection closed with {addr[0]}:{addr[1]}>")
+            conn.sendall(RESPONSE_HEADER.pack(STATUS_NOT_FOUND, 0, 0))
+            self.metrics.incr("peer.not_found")
+            logger.warning(f"<Error: File '{filename}' not found>")
+
+    def get_chunk_hashes(self, file_path: str) -> Tuple[int, List[bytes]]:
+        # SHA-256 of every CHUNK_SIZE block of the file, cached until the file's size or mtime changes
+        stat = os.stat(file_path)
+        with self.hash_cache_lock:
+            cached = self.hash_cache.get(file_path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return stat.st_size, cached[2]
+
+        digests = []
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, "rb") as f:
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                digests.append(hashlib.sha256(view[:n]).digest())
+
+        with self.hash_cache_lock:
+            self.hash_cache[file_path] = (stat.st_size, stat.st_mtime_ns, digests)
+        return stat.st_size, digests
+
+    @classmethod
+    def send_file_data(cls, conn, f, offset: int, count: int, shaper: Optional[UploadShaper] = None) -> int:
+        # Send count bytes of f starting at offset, returns the number of bytes sent
+        if count <= 0:
+            return 0
+
+        if shaper is not None:
+            # rate limited: sendfile slices of SHAPING_QUANTUM bytes, each once the limits allow it
+            sent = 0
+            while sent < count:
+                size = min(SHAPING_QUANTUM, count - sent)
+                shaper.acquire(size)
+                n = cls.send_file_data(conn, f, offset + sent, size)
+                sent += n
+                if n < size:
+                    break
+            return sent
+
+        if hasattr(os, "sendfile"):
+            # zero-copy path: the kernel moves the pages from the page cache straight to the socket
+            return conn.sendfile(f, offset, count)
+
+        # fallback for platforms without sendfile(): one large reusable buffer instead of many small reads
+        buffer = bytearray(min(SEND_BUFFER_SIZE, count))
+        view = memoryview(buffer)
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            read = f.readinto(view[:min(len(buffer), count - sent)])
+            if not read:
+                break
+            conn.sendall(view[:read])
+            sent += read
+        return sent
+
+    @classmethod
+    def send_file_frames(cls, conn, f, offset: int, count: int, codec: str,
+                         shaper: Optional[UploadShaper] = None) -> Tuple[int, int]:
+        # Send count bytes of f starting at offset as frames compressed with codec, returns (logical, wire) bytes.
+        # Frames that don't shrink go out raw; if the first COMPRESSION_SAMPLE_FRAMES don't compress well
+        # enough the rest of the range is not compressed at all and goes out raw through sendfile.
+        codec_id, compress, _ = CODECS[codec]
+        buffer = bytearray(min(COMPRESSION_FRAME_SIZE, count))
+        view = memoryview(buffer)
+        sent = wire = 0
+        sampled = sampled_wire = 0
+        bypass = False
+        while sent < count:
+            size = min(len(buffer), count - sent)
+            if bypass:
+                conn.sendall(FRAME_HEADER.pack(CODEC_RAW, size))
+                if cls.send_file_data(conn, f, offset + sent, size, shaper) < size:
+                    raise ValueError("file shrank while it was sent")
+                frame_wire = size
+            else:
+                f.seek(offset + sent)
+                if f.readinto(view[:size]) < size:
+                    raise ValueError("file shrank while it was sent")
+                data = compress(view[:size])
+                frame_wire = len(data) if len(data) < size else size
+                if shaper is not None:
+                    shaper.acquire(FRAME_HEADER.size + frame_wire)
+                if len(data) < size:
+                    conn.sendall(FRAME_HEADER.pack(codec_id, len(data)) + data)
+                else:
+                    conn.sendall(FRAME_HEADER.pack(CODEC_RAW, size))
+                    conn.sendall(view[:size])
+                if sampled < COMPRESSION_SAMPLE_FRAMES * COMPRESSION_FRAME_SIZE:
+                    sampled += size
+                    sampled_wire += frame_wire
+                    bypass = (sampled >= COMPRESSION_SAMPLE_FRAMES * COMPRESSION_FRAME_SIZE
+                              and sampled_wire > sampled * COMPRESSION_MIN_RATIO)
+            sent += size
+            wire += FRAME_HEADER.size + frame_wire
+        return sent, wire
 
     def run(self):
+        # the only reader of the UDP socket: control replies, table updates and server signals
         while True:
             try:
-                # Check for incoming table updates from the server
-                data, addr = self.udp_socket.recvfrom(1024)
-                message = data.decode().split(" ", 1)
-                if message[0] == "UPDATE":
-                    old_table = self.client_table.copy()
-                    self.update_client_table(message[1])
-                    if old_table != self.client_table:
-                        print("\n>>> [Client table updated.]", end="", flush=True)
+                data, addr = self.udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
             except OSError:
                 break
+            try:
+                self.handle_server_message(data)
+            except (ValueError, IndexError, struct.error) as e:
+                # a malformed datagram must not stop every later register, offer, search... from getting replies
+                self.metrics.incr("messages.invalid")
+                logger.warning(f"<Invalid message from the server: {e}>")
+
+    def handle_server_message(self, data: bytes):
+        data = self.assembler.add(data)
+        if data is None:
+            return
+        kind, _, payload = data.partition(b" ")
+        self.metrics.incr(f"messages.{kind.decode(errors='replace')}")
+        if kind == b"REP":
+            request_id, _, response = payload.partition(b" ")
+            request_id = int(request_id)
+            table = None
+            if response.startswith(b"WELCOME "):
+                # decoded before the request is taken, so a corrupt reply leaves it waiting for a retransmission
+                table = self.deserialize_table(response[len(b"WELCOME "):])
+            future = self.control.take(request_id)
+            if future is None:
+                return
+            if table is not None:
+                # installed here, the only thread that applies deltas to the table
+                self.install_table(*table)
+            future.set_result(response)
+        elif self.name not in self.client_table:
+            return  # not registered yet, the WELCOME brings the whole table
+        elif kind == b"UPDATE":
+            old_table = self.client_table.copy()
+            self.update_client_table(payload)
+            if old_table != self.client_table:
+                print("\n>>> [Client table updated.]", end="", flush=True)
+        elif kind == b"DELTA":
+            if self.apply_delta(payload.decode()):
+                print("\n>>> [Client table updated.]", end="", flush=True)
+        elif kind == b"REREGISTER":
+            # registering waits for a reply read by this thread
+            threading.Thread(target=self.reregister, daemon=True).start()
 
     def setdir(self, dir: str):
         if os.path.isdir(dir):
@@ -271,51 +2162,130 @@ class FileAppClient:
         else:
             print(f">>> [setdir failed: {dir} does not exist.]")
 
-    def offer(self, *filenames: str, retry: int = 2):
+    def local_path(self, filename: str) -> Optional[str]:
+        # Path of a shared file, which may be in a subdirectory; None for names that would leave dir
+        if self.dir is None:
+            return None
+        root = os.path.realpath(self.dir)
+        path = os.path.realpath(os.path.join(root, filename))
+        return path if path.startswith(root + os.sep) else None
+
+    def offer(self, *filenames: str):
         if self.dir is None:
             print(">>> [Error: setdir must be called before offering files.]")
             return
 
-        filenames = [filename for filename in filenames if os.path.isfile(os.path.join(self.dir, filename))]
+        if filenames == ("--all",):
+            self.offer_all()
+            return
+
+        filenames = [filename for filename in filenames if not any(c.isspace() for c in filename)
+                     and self.local_path(filename) is not None and os.path.isfile(self.local_path(filename))]
         if not filenames:
             print(">>> [No valid files to offer.]")
             return
 
-        # Update client's own table with the offered files
+        tokens = [self.offer_token(filename) for filename in filenames]
         for filename in filenames:
-            if filename not in self.client_table[self.name]["files"]:
-                self.client_table[self.name]["files"].append(filename)
-
-        message = f"OFFER {self.name} {' '.join(filenames)}"
-        self.udp_socket.sendto(message.encode(), (self.server_ip, self.server_port))
-
-        # Wait for ack from the server
-        attempts = 0
-        while attempts <= retry:
-            start_time = time.time()
-            while time.time() - start_time < 0.5:
-                data, addr = self.udp_socket.recvfrom(1024)
-                if data.decode() == "ACK":
-                    print(">>> [Offer Message received by Server.]")
-                    return
-            attempts += 1
+            stat = os.stat(self.local_path(filename))
+            self.offered_snapshot[filename] = (stat.st_size, stat.st_mtime_ns)
+        if self.send_file_changes("OFFER", tokens):
+            print(">>> [Offer Message received by Server.]")
+        else:
+            print(">>> [No ACK from Server, please try again later.]")
+
+    def offer_token(self, filename: str) -> str:
+        # Hash the file (cached by path, size and mtime, so re-offers cost a stat), add it to
+        # the client's own table and return its "<filename>:<content hash>" token
+        info = self.client_table[self.name]
+        path = self.local_path(filename)
+        digest = self.local_content_hash(path)
+        self.local_content[digest] = path
+        info.setdefault("hashes", {})[filename] = digest
+        if self.name not in self.file_index.lookup(filename):
+            info["files"].append(filename)
+            self.file_index.add(filename, self.name)
+        return f"{filename}:{digest}"
+
+    def offer_all(self, quiet: bool = False):
+        # Offer every file below dir. Later calls compare a fresh scan with the last one and only send
+        # the difference: new or modified files are offered (again), deleted ones withdrawn.
+        current = scan_directory(self.dir)
+        changed = [filename for filename, stat in current.items() if self.offered_snapshot.get(filename) != stat]
+        removed = [filename for filename in self.offered_snapshot if filename not in current]
+        if not changed and not removed:
+            if not quiet:
+                print(">>> [No changes to offer.]")
+            return
+
+        tokens = []
+        for filename in changed:
+            try:
+                tokens.append(self.offer_token(filename))
+            except OSError:
+                current.pop(filename)  # removed since the scan
+        info = self.client_table[self.name]
+        withdrawn = {filename for filename in removed if self.name in self.file_index.lookup(filename)}
+        for filename in withdrawn:
+            self.file_index.remove(filename, self.name)
+            info.get("hashes", {}).pop(filename, None)
+        if withdrawn:
+            info["files"] = [filename for filename in info["files"] if filename not in withdrawn]
+
+        acked = self.send_file_changes("OFFER", tokens) and self.send_file_changes("WITHDRAW", removed)
+        if acked:
+            self.offered_snapshot = current
+            print(f">>> [Offered {len(tokens)} files, withdrew {len(removed)} files.]")
+        else:
+            # the next scan sends the same changes again
+            print(">>> [No ACK from Server, please try again later.]")
+
+    def send_file_changes(self, command: str, tokens: List[str]) -> bool:
+        # Send OFFER or WITHDRAW for tokens in messages that fit one datagram, several in flight at once;
+        # True if the server acknowledged all of them
+        messages = []
+        prefix = f"{command} {self.name}".encode()
+        message = prefix
+        for token in tokens:
+            encoded = b" " + token.encode()
+            if len(prefix) + len(encoded) > CONTROL_MESSAGE_SIZE:
+                logger.warning(f"<'{token}' is too long to be offered, skipped>")
+                continue
+            if len(message) + len(encoded) > CONTROL_MESSAGE_SIZE:
+                messages.append(message)
+                message = prefix
+            message += encoded
+        if message != prefix:
+            messages.append(message)
+
+        acked = True
+        for start in range(0, len(messages), CONTROL_WINDOW):
+            replies = self.control.call_many(messages[start:start + CONTROL_WINDOW])
+            acked = acked and all(reply == b"ACK" for reply in replies)
+        return acked
+
+    def watch(self, interval: Optional[float] = WATCH_INTERVAL):
+        # Rescan dir every interval seconds in the background and send the changes; None stops watching
+        self.watch_stop.set()
+        if interval is None:
+            return
+        if not 0 < interval < float("inf"):
+            raise ValueError(f"watch interval must be greater than 0, not {interval}")
+        stop = self.watch_stop = threading.Event()
+
+        def rescan():
+            self.offer_all(quiet=True)
+            while not stop.wait(interval):
+                self.offer_all(quiet=True)
 
-        print(">>> [No ACK from Server, please try again later.]")
+        threading.Thread(target=rescan, daemon=True).start()
 
     def deregister(self):
         self.tcp_socket.close()
-        self.udp_socket.sendto(f"DEREG {self.name}".encode(), (self.server_ip, self.server_port))
-        attempts = 0
-        while attempts < 3:
-            self.udp_socket.settimeout(0.5)
-            try:
-                response, _ = self.udp_socket.recvfrom(1024)
-                if response.decode() == "ACK":
-                    print(">>> [You are Offline. Bye.]")
-                    return
-            except socket.timeout:
-                attempts += 1
-                self.udp_socket.sendto(f"DEREG {self.name}".encode(), (self.server_ip, self.server_port))
+        self.heartbeat_stop.set()
+        if self.control.call(f"DEREG {self.name}".encode()) == b"ACK":
+            print(">>> [You are Offline. Bye.]")
+            return
 
         print(">>> [Server not responding]")
         print(">>> [Exiting]")
@@ -331,84 +2301,489 @@ UDP server process:
 create socket(socket()) -> bind to port(bind()) -> receive data(recvfrom()) -> send reply(sendto()) -> server exit(close())
 '''
 
+class ServerProtocol(asyncio.DatagramProtocol):
+    # asyncio front end of FileAppServer, every datagram goes to the same handlers as in listen_udp
+    def __init__(self, server: "FileAppServer"):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.handle_message(data, addr)
+
+    def error_received(self, exc):
+        logger.warning(f">>> [UDP error: {exc}]")
+
+
+class StateLog:
+    # The server's client table on disk: table.snapshot holds the table (encode_table format) as of its
+    # version, table.log every delta recorded since, one "<version> <op>" line each. A line is written
+    # before the delta is broadcast, so a restarted server is back at the version its clients have.
+    # Once the log has compact_every lines the snapshot is rewritten and the log starts over.
+    SNAPSHOT_NAME = "table.snapshot"
+    LOG_NAME = "table.log"
+
+    def __init__(self, directory: str, compact_every: int = STATE_COMPACT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_NAME)
+        self.log_path = os.path.join(directory, self.LOG_NAME)
+        self.compact_every = compact_every
+        self.entries = 0
+        self.log_file = None
+
+    def load(self) -> Tuple[int, Dict[str, Dict[str, Union[str, int, List[str], bool]]], FileIndex]:
+        # Read the snapshot and replay the log on top of it, returns (version, table, file index)
+        version, table = 0, {}
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                version, table = decode_table(f.read())
+        file_index = FileIndex.from_table(table)
+
+        valid_length = 0
+        if os.path.isfile(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # torn by a crash in the middle of the write
+                    try:
+                        line_version, op = line[:-1].decode().split(" ", 1)
+                        line_version = int(line_version)
+                    except (UnicodeDecodeError, ValueError):
+                        logger.warning(f"<Skipped unreadable line in {self.log_path}: {line[:80]!r}>")
+                        valid_length += len(line)
+                        continue
+                    if line_version > version + 1:
+                        break  # lines after a gap can't be applied
+                    if line_version == version + 1:
+                        # older lines are already in the snapshot (a crash during compaction)
+                        try:
+                            apply_table_op(table, file_index, op)
+                        except (ValueError, IndexError):
+                            logger.warning(f"<Skipped invalid change {line_version} in {self.log_path}: {op[:80]}>")
+                        version += 1
+                        self.entries += 1
+                    valid_length += len(line)
+            os.truncate(self.log_path, valid_length)
+        self.log_file = open(self.log_path, 'a', encoding='utf-8')
+
+        valid_table = self.encodable_rows(table)
+        if len(valid_table) < len(table):
+            file_index = FileIndex.from_table(valid_table)
+        return version, valid_table, file_index
+
+    def append(self, version: int, op: str):
+        # flushed right away: the line survives the server process, an OS crash may lose the last few
+        self.log_file.write(f"{version} {op}\n")
+        self.log_file.flush()
+        self.entries += 1
+
+    def compact(self, version: int, table: Dict[str, Dict[str, Union[str, int, List[str], bool]]]):
+        # the new snapshot replaces the old one atomically before the log is cleared
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            data = encode_table(version, table)
+        except (ValueError, struct.error):
+            data = encode_table(version, self.encodable_rows(table))
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.log_file.close()
+        self.log_file = open(self.log_path, 'w', encoding='utf-8')
+        self.entries = 0
+
+    def encodable_rows(self, table: Dict[str, Dict[str, Union[str, int, List[str], bool]]]) \
+            -> Dict[str, Dict[str, Union[str, int, List[str], bool]]]:
+        # the table without rows encode_table can't store (e.g. a port out of range logged by an older version)
+        rows = {}
+        for name, info in table.items():
+            try:
+                encode_table(0, {name: info})
+                rows[name] = info
+            except (ValueError, struct.error):
+                logger.warning(f"<Dropped invalid entry '{name}' from the state in {os.path.dirname(self.log_path)}>")
+        return rows
+
+
 class FileAppServer:
-    def __init__(self, port):
+    def __init__(self, port, broadcast_window: float = 0.0, print_interval: Optional[float] = 0.0,
+                 report_interval: float = 0.0, heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+                 dead_entry_ttl: float = DEAD_ENTRY_TTL, state_dir: Optional[str] = None):
         self.port = port
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.bind(('', port))
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+
+        # set when running on asyncio (run_async), replies then go through the transport
+        self.transport = None
+        self.loop = None
 
         # key: client names, values: client info (ip, udp_port, tcp_port...)
         self.client_table = {}
 
+        # bumped by every mutation of client_table, clients use it to detect missed deltas
+        self.table_version = 0
+
+        # id of the last message sent in fragments
+        self.message_id = 0
+
+        # filename -> owners, answers SEARCH without scanning the table
+        self.file_index = FileIndex()
+
+        # deltas recorded since the last broadcast, and the table version before the first of them.
+        # With a broadcast window > 0 all mutations inside the window go out as one DELTA message.
+        self.broadcast_window = broadcast_window
+        self.pending_deltas = []
+        self.pending_base_version = 0
+        self.broadcast_scheduled = False
+
+        # print the table at most once per print_interval seconds (0: after every change, None: never)
+        self.print_interval = print_interval
+        self.last_print = 0.0
+        self.print_scheduled = False
+
+        # number of messages handled, reported every report_interval seconds in asyncio mode
+        self.report_interval = report_interval
+        self.messages_processed = 0
+
+        # id of the control request being handled (None for plain messages), and the replies sent to
+        # recent requests, key: (address, id), value: (expiry time, datagrams or a function building the
+        # reply again). reply_cache_bytes: size of the cached datagrams.
+        self.request_id = None
+        self.reply_cache = collections.OrderedDict()
+        self.reply_cache_bytes = 0
+
+        # liveness: ("expire", name) fires when a client's heartbeats stop, ("compact", name) when an
+        # offline entry is old enough to be dropped. stale_versions: table version of a client's last
+        # heartbeat if it was behind, a client behind at the same version twice gets the whole table.
+        self.heartbeat_timeout = heartbeat_timeout
+        self.dead_entry_ttl = dead_entry_ttl
+        self.timers = TimerWheel()
+        self.stale_versions = {}
+
+        # per message type counters and handling latency, broadcast fan-out time, table and queue sizes
+        self.metrics = Metrics()
+        self.metrics.gauge("clients.registered", lambda: len(self.client_table))
+        self.metrics.gauge("clients.online", lambda: sum(info["online"] for info in self.client_table.values()))
+        self.metrics.gauge("files.indexed", lambda: len(self.file_index.owners))
+        self.metrics.gauge("table.version", lambda: self.table_version)
+        self.metrics.gauge("broadcast.pending_deltas", lambda: len(self.pending_deltas))
+        self.metrics.gauge("timers.scheduled", lambda: len(self.timers.deadlines))
+        self.metrics.gauge("replies.cached_bytes", lambda: self.reply_cache_bytes)
+
+        # every table mutation is logged to state_dir (None: the table is only kept in memory)
+        self.state = None
+        if state_dir is not None:
+            self.restore_state(state_dir)
+
     # listening for incoming UDP msg
     def listen_udp(self):
+        # the socket timeout runs the liveness timers while no messages arrive
+        self.udp_socket.settimeout(TIMER_TICK)
         while True:
-            data, addr = self.udp_socket.recvfrom(1024)
+            try:
+                data, addr = self.udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+                self.handle_message(data, addr)
+            except socket.timeout:
+                pass
+            self.expire_clients()
+            self.print_due_table()
+
+    def handle_message(self, data: bytes, addr):
+        self.messages_processed += 1
+        start = time.perf_counter()
+        try:
+            if data.startswith(b"REQ "):
+                _, request_id, data = data.split(b" ", 2)
+                self.expire_replies()
+                cached = self.reply_cache.get((addr, int(request_id)))
+                if cached is not None:
+                    # the reply got lost, answer again without running the request twice
+                    _, reply = cached
+                    if callable(reply):
+                        reply = self.fragment(f"REP {int(request_id)} ".encode() + reply())
+                    for datagram in reply:
+                        self.sendto(datagram, addr)
+                    self.metrics.incr("requests.duplicate")
+                    return
+                self.request_id = int(request_id)
             message = data.decode().split(" ")
+            kind = message[0] if message[0] in SERVER_MESSAGES else "unknown"
             if message[0] == "REGISTER":
                 self.handle_registration(message[1:], addr)
-                self.print_client_table()
+                self.table_changed()
             elif message[0] == "DEREG":  # Change 'DISCONNECT' to 'DEREG' to match client's message
                 self.handle_deregistration(message[1:], addr)
-                self.print_client_table()
+                self.table_changed()
+            elif message[0] == "DISCONNECT":
+                self.handle_disconnect(message[1:])
+                self.table_changed()
+            elif message[0] == "HEARTBEAT":
+                self.handle_heartbeat(message[1:], addr)
             elif message[0] == "ACK":
                 pass  # Do nothing, just acknowledge the receipt of the update
             elif message[0] == "OFFER":
-                self.handle_offer(message[1:])
-                self.print_client_table()
+                self.handle_offer(message[1:], addr)
+                self.table_changed()
+            elif message[0] == "WITHDRAW":
+                self.handle_withdraw(message[1:], addr)
+                self.table_changed()
+            elif message[0] == "SNAPSHOT":
+                self.handle_snapshot(message[1:], addr)
+            elif message[0] == "SEARCH":
+                self.handle_search(message[1:], addr)
+            elif message[0] == "STATS":
+                self.handle_stats(addr)
+        except (ValueError, IndexError, struct.error):
+            kind = "invalid"
+            logger.warning(f">>> [Invalid message from {addr[0]}:{addr[1]}]")
+        finally:
+            self.request_id = None
+        self.metrics.incr(f"messages.{kind}")
+        self.metrics.observe(f"handle.{kind}", time.perf_counter() - start)
+
+    def reply(self, message: bytes, addr, rebuild: Optional[Callable[[], bytes]] = None):
+        # Answer the message being handled. The reply to a control request carries its id and is cached,
+        # so a retransmission of the request is answered again without being handled twice.
+        # rebuild returns the reply as of now, it is cached instead of replies larger than one datagram.
+        if self.request_id is None:
+            self.send_message(message, addr)
+            return
+        datagrams = self.fragment(f"REP {self.request_id} ".encode() + message)
+        self.cache_reply((addr, self.request_id), rebuild if rebuild is not None and len(datagrams) > 1 else datagrams)
+        for datagram in datagrams:
+            self.sendto(datagram, addr)
+
+    def cache_reply(self, key, reply):
+        self.expire_replies()
+        if key in self.reply_cache:
+            self.drop_reply(key)
+        self.reply_cache[key] = (time.monotonic() + REPLY_CACHE_TTL, reply)
+        if not callable(reply):
+            self.reply_cache_bytes += sum(len(datagram) for datagram in reply)
+        while self.reply_cache and (len(self.reply_cache) > REPLY_CACHE_SIZE
+                                    or self.reply_cache_bytes > REPLY_CACHE_BYTES):
+            self.drop_reply(next(iter(self.reply_cache)))
+
+    def expire_replies(self):
+        # entries are in the order they were cached, so the expired ones are at the front
+        now = time.monotonic()
+        while self.reply_cache:
+            key = next(iter(self.reply_cache))
+            if self.reply_cache[key][0] > now:
+                break
+            self.drop_reply(key)
+
+    def drop_reply(self, key):
+        _, reply = self.reply_cache.pop(key)
+        if not callable(reply):
+            self.reply_cache_bytes -= sum(len(datagram) for datagram in reply)
+
+    def sendto(self, data: bytes, addr):
+        if self.transport is not None:
+            self.transport.sendto(data, addr)
+        else:
+            self.udp_socket.sendto(data, addr)
 
     def handle_deregistration(self, message, addr):
         nickname = message[0]
 
         if nickname in self.client_table:
             self.client_table[nickname]["online"] = False
-            self.udp_socket.sendto("ACK".encode(), addr)
+            self.reply(b"ACK", addr)
+            self.timers.cancel(("expire", nickname))
+            self.timers.schedule(("compact", nickname), self.dead_entry_ttl)
 
-            # Broadcast the updated client_table to all online clients
-            self.broadcast_table()
+            # Broadcast the change to all online clients
+            self.broadcast_delta(f"LEAVE {nickname}")
         else:
-            print(f">>> Invalid de-registration request: Client '{nickname}' not found.")
+            logger.warning(f">>> Invalid de-registration request: Client '{nickname}' not found.")
 
-    def handle_offer(self, message):
+    def handle_offer(self, message, addr):
         client_name = message[0]
         offered_files = message[1:]
 
         if client_name in self.client_table:
             client = self.client_table[client_name]
-            for filename in offered_files:
-                if filename not in client["files"]:
+            new_files = []
+            for token in offered_files:
+                filename, digest = split_file_token(token)
+                if client_name not in self.file_index.lookup(filename):
                     client["files"].append(filename)
-            self.broadcast_table()
-            self.udp_socket.sendto("ACK".encode(), (client["ip"], client["udp_port"]))
+                    self.file_index.add(filename, client_name)
+                elif digest == client["hashes"].get(filename):
+                    continue
+                # new file, or new content under a known name
+                if digest:
+                    client["hashes"][filename] = digest
+                new_files.append(token)
+            if new_files:
+                self.broadcast_delta(f"FILES {client_name} {' '.join(new_files)}")
+            self.reply(b"ACK", addr)
+
+    def handle_withdraw(self, message, addr):
+        # WITHDRAW <name> <filename> ...: the client no longer offers these files
+        client_name = message[0]
+        if client_name in self.client_table:
+            client = self.client_table[client_name]
+            withdrawn = {filename for filename in message[1:] if client_name in self.file_index.lookup(filename)}
+            for filename in withdrawn:
+                self.file_index.remove(filename, client_name)
+                client["hashes"].pop(filename, None)
+            if withdrawn:
+                client["files"] = [filename for filename in client["files"] if filename not in withdrawn]
+                self.broadcast_delta(f"WITHDRAW {client_name} {' '.join(sorted(withdrawn))}")
+            self.reply(b"ACK", addr)
 
     def handle_registration(self, message, addr):
         name, ip, udp_port, tcp_port = message
-        if name in self.client_table and self.client_table[name]["online"]:
-            self.udp_socket.sendto("ERROR".encode(), addr)
+        valid = (self.is_valid_ip(ip) and udp_port.isdigit() and tcp_port.isdigit()
+                 and self.is_valid_port(int(udp_port)) and self.is_valid_port(int(tcp_port)))
+        if not valid:
+            # the table (and its encoding) only holds IPv4 addresses and 16 bit ports
+            logger.warning(f">>> Invalid registration request from {addr[0]}:{addr[1]}: {' '.join(message)}")
+            self.reply(b"ERROR", addr)
+        elif name in self.client_table and self.client_table[name]["online"]:
+            self.reply(b"ERROR", addr)
         else:
             self.client_table[name] = {
                 "ip": ip,
                 "udp_port": int(udp_port),
                 "tcp_port": int(tcp_port),
                 "files": self.client_table.get(name, {}).get("files", []),
+                "hashes": self.client_table.get(name, {}).get("hashes", {}),
                 "online": True
             }
-            table_data = self.serialize_table()
-            self.udp_socket.sendto(f"WELCOME {table_data}".encode(), addr)
-            self.broadcast_table()
+            self.timers.cancel(("compact", name))
+            self.timers.schedule(("expire", name), self.heartbeat_timeout)
+
+            # the new client gets the table as of the JOIN, so it skips the JOIN delta itself
+            self.record_delta(self.join_delta(name))
+            # a retransmitted REGISTER gets the table as it is by then
+            self.reply(b"WELCOME " + self.serialize_table(self.table_version), addr,
+                       rebuild=lambda: b"WELCOME " + self.serialize_table(self.table_version))
+            self.schedule_broadcast()
+
+    def join_delta(self, name: str) -> str:
+        info = self.client_table[name]
+        files = [f"{filename}:{info['hashes'][filename]}" if filename in info["hashes"] else filename
+                 for filename in info["files"]]
+        return f"JOIN {name} {info['ip']} {info['udp_port']} {info['tcp_port']} {' '.join(files)}"
+
+    def handle_search(self, message, addr):
+        # SEARCH <pattern> [page]: one page of matching files that have an online owner,
+        # "RESULTS <page> <pages> <total>" followed by "<filename> <owner>@<ip>:<tcp port>,..." rows
+        pattern = message[0]
+        page = int(message[1]) if len(message) > 1 else 0
+
+        matches = []
+        for filename in self.file_index.search(pattern):
+            owners = [name for name in sorted(self.file_index.lookup(filename)) if self.client_table[name]["online"]]
+            if owners:
+                matches.append((filename, owners))
+
+        pages = max(1, -(-len(matches) // SEARCH_PAGE_SIZE))
+        rows = [f"{page} {pages} {len(matches)}"]
+        for filename, owners in matches[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]:
+            info = self.client_table
+            rows.append(f"{filename} " + ",".join(f"{name}@{info[name]['ip']}:{info[name]['tcp_port']}" for name in owners))
+        self.reply(("RESULTS " + "\n".join(rows)).encode(), addr)
+
+    def handle_snapshot(self, message, addr):
+        # a client detected a version gap and wants the full table
+        name = message[0]
+        if name in self.client_table:
+            self.send_message(b"UPDATE " + self.serialize_table(self.table_version), addr)
 
-    def serialize_table(self) -> str:
-        rows = []
-        for name, info in self.client_table.items():
-            row = f"{name} {info['ip']} {info['udp_port']} {info['tcp_port']} {int(info['online'])} {' '.join(info['files'])}"
-            rows.append(row)
-        return '\n'.join(rows)
+    def handle_stats(self, addr):
+        # STATS: the server's metrics as JSON, fragmented like any large reply
+        self.reply(b"STATS " + json.dumps(self.metrics.snapshot()).encode(), addr,
+                   rebuild=lambda: b"STATS " + json.dumps(self.metrics.snapshot()).encode())
+
+    def serialize_table(self, version: int) -> bytes:
+        return encode_table(version, self.client_table)
+
+    def fragment(self, message: bytes) -> List[bytes]:
+        self.message_id = (self.message_id + 1) & 0xFFFFFFFF
+        return fragment_message(message, self.message_id)
+
+    def send_message(self, message: bytes, addr):
+        # send a message that may be larger than one datagram
+        for datagram in self.fragment(message):
+            self.sendto(datagram, addr)
 
     def handle_disconnect(self, message):
+        # DISCONNECT <name>: the client quit without waiting for an answer
         name = message[0]
-        if name in self.client_table:
+        if name in self.client_table and self.client_table[name]["online"]:
             self.client_table[name]["online"] = False
-            self.broadcast_table()
+            self.timers.cancel(("expire", name))
+            self.timers.schedule(("compact", name), self.dead_entry_ttl)
+            self.broadcast_delta(f"LEAVE {name}")
+
+    def handle_heartbeat(self, message, addr):
+        # HEARTBEAT <name> <table version>
+        name, version = message[0], int(message[1])
+        info = self.client_table.get(name)
+        if info is None:
+            # dropped after dead_entry_ttl, or registered before a restart without --state-dir
+            self.send_message(b"REREGISTER", addr)
+            self.metrics.incr("heartbeat.unknown")
+            return
+        if not info["online"]:
+            # timed out while still running (e.g. the network was down for a while): back in the table
+            info["online"] = True
+            self.timers.cancel(("compact", name))
+            self.broadcast_delta(self.join_delta(name))
+            self.table_changed()
+        self.timers.schedule(("expire", name), self.heartbeat_timeout)
+
+        if version > self.table_version:
+            # ahead of the server: it restarted from a state that misses the last changes
+            self.send_message(b"UPDATE " + self.serialize_table(self.table_version), addr)
+            self.metrics.incr("heartbeat.repairs")
+        # behind with nothing left to broadcast means the client lost the last delta
+        elif version < self.table_version and not self.pending_deltas:
+            if self.stale_versions.get(name) == version:
+                self.send_message(b"UPDATE " + self.serialize_table(self.table_version), addr)
+                self.metrics.incr("heartbeat.repairs")
+            self.stale_versions[name] = version
+        else:
+            self.stale_versions.pop(name, None)
+
+    def expire_clients(self):
+        # Mark clients whose heartbeats stopped offline, and drop entries that were offline for long
+        changed = False
+        for action, name in self.timers.advance():
+            info = self.client_table.get(name)
+            if info is None:
+                continue
+            if action == "expire" and info["online"]:
+                info["online"] = False
+                logger.info(f"<Client '{name}' stopped sending heartbeats, marked offline>")
+                self.metrics.incr("clients.expired")
+                self.record_delta(f"LEAVE {name}")
+                self.timers.schedule(("compact", name), self.dead_entry_ttl)
+                changed = True
+            elif action == "compact" and not info["online"]:
+                for filename in info["files"]:
+                    self.file_index.remove(filename, name)
+                del self.client_table[name]
+                self.stale_versions.pop(name, None)
+                self.metrics.incr("clients.compacted")
+                self.record_delta(f"REMOVE {name}")
+                changed = True
+        if changed:
+            self.schedule_broadcast()
+            self.table_changed()
+
+    def run_timers(self):
+        # asyncio mode: expire clients every tick
+        self.expire_clients()
+        if self.loop is not None:
+            self.loop.call_later(TIMER_TICK, self.run_timers)
 
     @staticmethod
     def is_valid_ip(ip: str) -> bool:
@@ -428,48 +2803,201 @@ class FileAppServer:
             print(f"{name}: {info}")
         print("\n")
 
-    def broadcast_table(self):
-        table_data = self.serialize_table()
+    def table_changed(self):
+        # print the table, rate limited to one print per print_interval
+        if self.print_interval is None:
+            return
+        now = time.monotonic()
+        if now - self.last_print >= self.print_interval:
+            self.last_print = now
+            self.print_client_table()
+        elif not self.print_scheduled:
+            # make sure the last change of a burst is still shown: by a timer on asyncio,
+            # by listen_udp once the interval has passed otherwise
+            self.print_scheduled = True
+            if self.loop is not None:
+                self.loop.call_later(self.print_interval - (now - self.last_print), self.print_pending_table)
+
+    def print_due_table(self):
+        # blocking server: show a change that table_changed held back, once print_interval has passed
+        if self.print_scheduled and time.monotonic() - self.last_print >= self.print_interval:
+            self.print_pending_table()
+
+    def print_pending_table(self):
+        self.print_scheduled = False
+        self.last_print = time.monotonic()
+        self.print_client_table()
+
+    def record_delta(self, delta: str):
+        # Bump the table version for one mutation and queue the change for the next broadcast
+        if not self.pending_deltas:
+            self.pending_base_version = self.table_version
+        self.pending_deltas.append(delta)
+        self.table_version += 1
+        if self.state is not None:
+            self.state.append(self.table_version, delta)
+            if self.state.entries >= self.state.compact_every:
+                with self.metrics.timer("state.compact"):
+                    self.state.compact(self.table_version, self.client_table)
+
+    def restore_state(self, state_dir: str):
+        # Rebuild the table from state_dir. Clients keep running while the server is down, so the
+        # table is still valid: they get one BUMP delta instead of having to register again. Those
+        # whose version doesn't match it ask for a snapshot, and heartbeats time out clients that quit.
+        start = time.perf_counter()
+        self.state = StateLog(state_dir)
+        self.table_version, self.client_table, self.file_index = self.state.load()
         for name, info in self.client_table.items():
-            if info['online']:
-                addr = (info['ip'], info['udp_port'])
-                self.udp_socket.sendto(f"UPDATE {table_data}".encode(), addr)
+            if info["online"]:
+                self.timers.schedule(("expire", name), self.heartbeat_timeout)
             else:
-                self.udp_socket.sendto(f"DISCONNECTED {name}".encode(), (info['ip'], info['udp_port']))
+                self.timers.schedule(("compact", name), self.dead_entry_ttl)
+        self.state.compact(self.table_version, self.client_table)
+        self.metrics.gauge("state.log_entries", lambda: self.state.entries)
+        logger.info(f"<Restored {len(self.client_table)} clients at table version {self.table_version} "
+                    f"from {state_dir} in {(time.perf_counter() - start) * 1000:.1f} ms>")
+        if self.client_table:
+            self.broadcast_delta(f"BUMP {self.table_version}")
+
+    def schedule_broadcast(self):
+        if self.loop is None or self.broadcast_window <= 0:
+            self.flush_broadcast()
+        elif not self.broadcast_scheduled:
+            # coalesce: every mutation until the window closes goes out in the same message
+            self.broadcast_scheduled = True
+            self.loop.call_later(self.broadcast_window, self.flush_broadcast)
+
+    def broadcast_delta(self, delta: str):
+        self.record_delta(delta)
+        self.schedule_broadcast()
+
+    def flush_broadcast(self):
+        # Send the queued changes to every client instead of the whole table
+        self.broadcast_scheduled = False
+        if not self.pending_deltas:
+            return
+        delta = "\n".join(self.pending_deltas)
+        self.pending_deltas = []
+        datagrams = self.fragment(f"DELTA {self.pending_base_version}\n{delta}".encode())
+        with self.metrics.timer("broadcast.fanout"):
+            # only live clients: offline ones stopped sending heartbeats or left
+            for info in self.client_table.values():
+                if info['online']:
+                    addr = (info['ip'], info['udp_port'])
+                    for datagram in datagrams:
+                        self.sendto(datagram, addr)
+                    self.metrics.incr("broadcast.datagrams", len(datagrams))
+        self.metrics.incr("broadcast.messages")
 
     def run(self):
-        print(f"Server started on port {self.port}. Waiting for incoming messages...")
+        logger.info(f"Server started on port {self.port}. Waiting for incoming messages...")
         self.listen_udp()
 
+    def run_async(self):
+        logger.info(f"Server started on port {self.port} (asyncio). Waiting for incoming messages...")
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: ServerProtocol(self), sock=self.udp_socket)
+        self.loop.call_later(TIMER_TICK, self.run_timers)
+        try:
+            last_count = self.messages_processed
+            last_time = time.monotonic()
+            while True:
+                await asyncio.sleep(self.report_interval if self.report_interval > 0 else 3600)
+                if self.report_interval > 0:
+                    now = time.monotonic()
+                    rate = (self.messages_processed - last_count) / (now - last_time)
+                    logger.info(f"<Processed {self.messages_processed - last_count} messages ({rate:.0f} msg/s)>")
+                    last_count, last_time = self.messages_processed, now
+        finally:
+            transport.close()
+            self.transport = None
+            self.loop = None
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="File Transfer App")
     parser.add_argument("-s", "--server", type=int, help="Start a server at the specified port")
     parser.add_argument("-c", "--client", nargs=5, help="Start a client with: name, server IP, server port, udp port, tcp port")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS, help="Number of concurrent uploads")
+    parser.add_argument("--upload-queue", type=int, default=UPLOAD_QUEUE,
+                        help="Connections that may wait for an upload worker before peers are told to retry later")
+    parser.add_argument("--upload-limit", type=parse_byte_size, default=None,
+                        help="Upload rate limit of all peers together in bytes per second (e.g. 10M), shared round-robin")
+    parser.add_argument("--peer-limit", type=parse_byte_size, default=None,
+                        help="Upload rate limit of each peer connection in bytes per second (e.g. 2M)")
+    parser.add_argument("--backlog", type=int, default=TCP_BACKLOG, help="listen() backlog of the peer TCP server")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help="Seconds a peer connection may stall before it is closed")
+    parser.add_argument("--busy-retry-ms", type=int, default=BUSY_RETRY_MS,
+                        help="Retry delay in milliseconds sent to peers while the upload queue is full")
+    parser.add_argument("--async-server", action="store_true", help="Run the server on asyncio with coalesced broadcasts")
+    parser.add_argument("--broadcast-window", type=float, default=0.05,
+                        help="Seconds during which table changes are collected into one broadcast (asyncio server)")
+    parser.add_argument("--print-interval", type=float, default=0.0,
+                        help="Print the client table at most once per interval seconds (0: after every change, -1: never)")
+    parser.add_argument("--report-interval", type=float, default=0.0,
+                        help="Print the number of messages processed per second every interval seconds (asyncio server)")
+    parser.add_argument("--codecs", default=None,
+                        help="Compression codecs offered to peers for downloads, in order of preference (e.g. zlib,lzma)")
+    parser.add_argument("--reseed", action="store_true", help="Offer every downloaded file to other clients")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="Seconds without a heartbeat after which the server marks a client offline")
+    parser.add_argument("--dead-entry-ttl", type=float, default=DEAD_ENTRY_TTL,
+                        help="Seconds after which the server drops an offline client from the table")
+    parser.add_argument("--state-dir", default=None,
+                        help="Directory where the server logs the client table, restored from it on restart")
+    parser.add_argument("--recv-buffer", type=parse_byte_size, default=RECV_BUFFER_SIZE,
+                        help=f"Size in bytes of the download receive buffer, at least {CHUNK_SIZE} (one chunk) "
+                             "and rounded down to whole chunks")
+    parser.add_argument("--rcvbuf", type=int, default=None, help="SO_RCVBUF in bytes for download sockets (default: OS default)")
+
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Diagnostics to print: DEBUG adds every connection and request, WARNING only problems")
 
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    if args.recv_buffer < CHUNK_SIZE:
+        parser.error(f"--recv-buffer must be at least {CHUNK_SIZE} bytes (one chunk)")
 
     if args.server:
-        server = FileAppServer(args.server)
-        server.run()
+        server = FileAppServer(args.server,
+                               broadcast_window=args.broadcast_window,
+                               print_interval=args.print_interval if args.print_interval >= 0 else None,
+                               report_interval=args.report_interval,
+                               heartbeat_timeout=args.heartbeat_timeout,
+                               dead_entry_ttl=args.dead_entry_ttl,
+                               state_dir=args.state_dir)
+        if args.async_server:
+            server.run_async()
+        else:
+            server.run()
     elif args.client:
         name, server_ip, server_port, udp_port, tcp_port = args.client
-        client = FileAppClient(name, server_ip, int(server_port), int(udp_port), int(tcp_port))
+        client = FileAppClient(name, server_ip, int(server_port), int(udp_port), int(tcp_port),
+                               recv_buffer_size=args.recv_buffer, socket_rcvbuf=args.rcvbuf,
+                               upload_workers=args.upload_workers, upload_queue=args.upload_queue,
+                               tcp_backlog=args.backlog, read_timeout=args.read_timeout,
+                               busy_retry_ms=args.busy_retry_ms,
+                               codecs=args.codecs.split(",") if args.codecs else None, reseed=args.reseed,
+                               upload_limit=args.upload_limit, peer_limit=args.peer_limit)
+        # Start a separate thread for client.run() to listen for updates and replies from the server
+        update_listener_thread = threading.Thread(target=client.run, daemon=True)
+        update_listener_thread.start()
+
         client.register()
 
         # Start the TCP server for handling file requests in a separate thread
         tcp_server_thread = threading.Thread(target=client.start_tcp_server, args=(int(tcp_port),), daemon=True)
         tcp_server_thread.start()
 
-        # Start a separate thread for client.run() to listen for updates from the server
-        update_listener_thread = threading.Thread(target=client.run, daemon=True)
-        update_listener_thread.start()
-
         # client.listen_for_disconnect()
 
         while True:
             try:
-                command = input("Enter command (setdir/offer/table/help/list/request/dereg/disconnect): ").strip().lower()
+                command = input("Enter command (setdir/offer/table/help/list/request/stats/dereg/disconnect): ").strip().lower()
                 if command.startswith("setdir"):
                     command_split = command.split(" ", 1)
                     if len(command_split) == 2:
@@ -481,18 +3009,60 @@ if __name__ == "__main__":
                 elif command.startswith("offer"):
                     _, *filenames = command.split(" ")
                     client.offer(*filenames)
+                elif command.startswith("watch"):
+                    command_split = command.split(" ")
+                    if len(command_split) == 2 and command_split[1] == "off":
+                        client.watch(None)
+                        print(">>> [Stopped watching.]")
+                    else:
+                        try:
+                            interval = float(command_split[1]) if len(command_split) == 2 else WATCH_INTERVAL
+                        except ValueError:
+                            interval = None
+                        if len(command_split) > 2 or interval is None or not 0 < interval < float("inf"):
+                            print(">>> [Error: watch needs an interval in seconds greater than 0. Usage: watch [seconds|off]]")
+                        elif client.dir is None:
+                            print(">>> [Error: setdir must be called before watching.]")
+                        else:
+                            client.watch(interval)
+                            print(f">>> [Watching {client.dir}, rescanning every {interval:g} seconds.]")
                 elif command == "table":
                     client.print_client_table()
                 elif command == "list":
                     client.list_files()
                 elif command.startswith("request"):
                     command_split = command.split(" ")
-                    if len(command_split) == 3:
+                    if len(command_split) == 3 and command_split[2] == "--parallel":
+                        client.request_file_parallel(command_split[1])
+                    elif len(command_split) == 2:
+                        client.request_file(command_split[1])
+                    elif len(command_split) == 3 and not any(c in command_split[1] for c in "*?["):
                         _, filename, target_client = command_split
                         client.request_file(filename, target_client)
+                    elif len(command_split) >= 3:
+                        # several files or a pattern: one pipelined connection to that client
+                        *_, target_client = command_split
+                        client.request_batch(target_client, *command_split[1:-1])
+                    else:
+                        print(">>> [Error: request command requires a filename. "
+                              "Usage: request <filename|pattern> ... [client] or request <filename> --parallel]")
+                elif command.startswith("search"):
+                    command_split = command.split(" ")
+                    if len(command_split) in (2, 3) and (len(command_split) == 2 or command_split[2].isdigit()):
+                        page = int(command_split[2]) - 1 if len(command_split) == 3 else 0
+                        client.search(command_split[1], max(page, 0))
+                    else:
+                        print(">>> [Error: search command requires a pattern and an optional page number. Usage: search <pattern> [page]]")
+                elif command.startswith("batch"):
+                    command_split = command.split(" ")
+                    # same as request <filename|pattern> ... <client>
+                    if len(command_split) >= 3:
+                        _, target_client, *patterns = command_split
+                        client.request_batch(target_client, *patterns)
                     else:
-                        print(
-                            ">>> [Error: request command requires a filename and client name. Usage: request <filename> <client>]")
+                        print(">>> [Error: batch command requires a client and filenames. Usage: batch <client> <filename|pattern> ...]")
+                elif command.startswith("stats"):
+                    client.stats(server=command == "stats server")
                 elif command == "dereg":
                     client.deregister()
 
@@ -502,8 +3072,15 @@ if __name__ == "__main__":
                 elif command == "help":
                     print("Available commands:")
                     print("  setdir      - set the directory for searching offered files")
-                    print("  offer       - offer one or more files to other clients")
+                    print("  offer       - offer one or more files (paths below the directory), or --all for the whole tree")
+                    print("  watch       - watch [seconds] keeps the whole tree offered by rescanning it, watch off stops")
                     print("  table       - print the client table")
+                    print("  list        - list the files offered by all clients")
+                    print("  request     - request <filename> [client]: from that client or the least loaded owner; --parallel: from all")
+                    print("                request <filename|pattern> ... <client>: many files over one connection")
+                    print("  search      - search <pattern> [page] asks the server for matching files (glob or substring)")
+                    print("  batch       - batch <client> <filename|pattern> ... same as request with several files")
+                    print("  stats       - print this client's metrics as JSON, or 'stats server' for the server's")
                     print("  help        - show this help message")
                     print("  disconnect  - disconnect and notify the server")
                 elif command == "disconnect":
@@ -0,0 +1,751 @@
+import collections
+import io
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+import main
+from main import CHUNK_SIZE, COMPRESSION_FRAME_SIZE, FRAME_HEADER, RESPONSE_HEADER, STATUS_NOT_FOUND, STATUS_OK, \
+    DownloadJournal, FileAppClient, FileAppServer, FileIndex, PayloadReader, TimerWheel, TokenBucket, decode_table, \
+    encode_table, split_file_token
+
+DIGEST = "0123456789abcdef" * 2  # CONTENT_HASH_SIZE bytes as hex
+
+
+class TableEncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        table = {
+            "alice": {"ip": "10.0.0.1", "udp_port": 1024, "tcp_port": 65535, "files": ["a.txt", "shared.csv"],
+                      "hashes": {"a.txt": DIGEST}, "online": True},
+            "bob": {"ip": "10.0.0.2", "udp_port": 5001, "tcp_port": 5002, "files": ["shared.csv"],
+                    "hashes": {}, "online": False},
+            "carol": {"ip": "10.0.0.3", "udp_port": 5003, "tcp_port": 5004, "files": [], "hashes": {}, "online": True},
+        }
+        self.assertEqual(decode_table(encode_table(42, table)), (42, table))
+
+    def test_empty_table(self):
+        self.assertEqual(decode_table(encode_table(0, {})), (0, {}))
+
+    def test_port_out_of_range(self):
+        table = {"x": {"ip": "10.0.0.1", "udp_port": 70000, "tcp_port": 5000, "files": [], "hashes": {}, "online": True}}
+        with self.assertRaises(struct.error):
+            encode_table(0, table)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            decode_table(b"\xff")
+
+
+class RegistrationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FileAppServer(0, print_interval=None)
+        self.sent = []
+        self.server.sendto = lambda data, addr: self.sent.append(data)
+
+    def tearDown(self):
+        self.server.udp_socket.close()
+
+    def register(self, request_id: int, message: str) -> bytes:
+        # the reply, the JOIN broadcast may follow it
+        self.sent.clear()
+        self.server.handle_message(f"REQ {request_id} REGISTER {message}".encode(), ("127.0.0.1", 4000))
+        return self.sent[0]
+
+    def test_invalid_ports_and_addresses_are_rejected(self):
+        for i, message in enumerate(["x 127.0.0.1 70000 5001", "x 127.0.0.1 5000 80", "x 127.0.0.1 5000 port",
+                                     "x 999.0.0.1 5000 5001", "x localhost 5000 5001"]):
+            self.assertEqual(self.register(i, message), f"REP {i} ERROR".encode())
+        self.assertEqual(self.server.client_table, {})
+        self.assertEqual(self.server.table_version, 0)
+
+    def test_valid_registration(self):
+        self.assertTrue(self.register(1, "alice 127.0.0.1 5000 5001").startswith(b"REP 1 WELCOME "))
+        self.assertTrue(self.server.client_table["alice"]["online"])
+        # the table still encodes after a rejected registration
+        self.register(2, "bob 127.0.0.1 5000 99999")
+        self.assertEqual(list(decode_table(self.server.serialize_table(0))[1]), ["alice"])
+
+
+class ControlChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = mock.Mock()
+        self.metrics = main.Metrics()
+        self.channel = main.ControlChannel(self.sock, ("127.0.0.1", 4000), self.metrics, timeout=0.01, retries=3)
+
+    def answer_after(self, sends: int, reply=lambda request_id: b"ACK"):
+        # the server answers every request once it has been sent this many times
+        counts = collections.Counter()
+
+        def sendto(data, address):
+            request_id = int(data.split(b" ")[1])
+            counts[request_id] += 1
+            if counts[request_id] == sends:
+                self.channel.take(request_id).set_result(reply(request_id))
+        self.sock.sendto.side_effect = sendto
+        return counts
+
+    def test_retransmits_until_answered(self):
+        counts = self.answer_after(3)
+        self.assertEqual(self.channel.call(b"PING"), b"ACK")
+        self.assertEqual(list(counts.values()), [3])
+        self.assertEqual(self.metrics.snapshot()["counters"]["control.retransmits"], 2)
+        self.assertEqual(self.channel.pending, {})
+
+    def test_gives_up(self):
+        counts = self.answer_after(0)
+        self.assertIsNone(self.channel.call(b"PING"))
+        self.assertEqual(list(counts.values()), [4])
+        self.assertEqual(self.metrics.snapshot()["counters"]["control.timeouts"], 1)
+        self.assertEqual(self.channel.pending, {})
+
+    def test_replies_in_request_order(self):
+        self.answer_after(1, reply=lambda request_id: str(request_id).encode())
+        replies = self.channel.call_many([b"A", b"B", b"C"])
+        self.assertEqual([int(reply) for reply in replies], sorted(int(reply) for reply in replies))
+        self.assertEqual(len(set(replies)), 3)
+
+    def test_late_reply_is_dropped(self):
+        self.answer_after(0)
+        self.channel.call(b"PING")
+        request_id = int(self.sock.sendto.call_args[0][0].split(b" ")[1])
+        self.assertIsNone(self.channel.take(request_id))
+
+
+class ReplyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(main.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = FileAppServer(0, print_interval=None)
+        self.addCleanup(self.server.udp_socket.close)
+        self.sent = []
+        self.server.sendto = lambda data, addr: self.sent.append(data)
+
+    def send(self, message: str, port: int = 4000) -> bytes:
+        self.sent.clear()
+        self.server.handle_message(message.encode(), ("127.0.0.1", port))
+        return self.sent[0] if self.sent else None
+
+    def test_retransmission_is_answered_from_the_cache(self):
+        reply = self.send("REQ 1 REGISTER alice 127.0.0.1 5000 5001")
+        version = self.server.table_version
+        self.assertEqual(self.send("REQ 1 REGISTER alice 127.0.0.1 5000 5001"), reply)
+        self.assertEqual(self.server.table_version, version)
+        self.assertEqual(self.server.metrics.snapshot()["counters"]["requests.duplicate"], 1)
+
+    def test_expiry(self):
+        self.send("REQ 1 REGISTER alice 127.0.0.1 5000 5001")
+        self.now += main.REPLY_CACHE_TTL + 1
+        self.send("REQ 2 HEARTBEAT alice 0")
+        self.assertNotIn((("127.0.0.1", 4000), 1), self.server.reply_cache)
+
+    def test_size_bounds(self):
+        with mock.patch.object(main, "REPLY_CACHE_SIZE", 3):
+            for i in range(10):
+                self.send(f"REQ {i} SEARCH x", port=4000 + i)
+            self.assertEqual([key[1] for key in self.server.reply_cache], [7, 8, 9])
+        with mock.patch.object(main, "REPLY_CACHE_BYTES", 100):
+            for i in range(10, 20):
+                self.send(f"REQ {i} SEARCH x", port=4000 + i)
+            self.assertLessEqual(self.server.reply_cache_bytes, 100)
+            self.assertEqual(self.server.reply_cache_bytes, sum(sum(len(datagram) for datagram in reply)
+                                                                 for _, reply in self.server.reply_cache.values()))
+
+
+class ApplyDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FileAppClient("a", "127.0.0.1", 0, 0, 0)
+        self.client.udp_socket.close()
+        self.client.tcp_socket.close()
+        self.client.udp_socket = mock.Mock()
+        self.client.install_table(2, {})
+        self.client.udp_socket.reset_mock()
+
+    def test_ops_advance_the_version(self):
+        self.assertTrue(self.client.apply_delta("2\nJOIN bob 10.0.0.2 5000 5001 x.txt\nFILES bob y.txt"))
+        self.assertEqual(self.client.table_version, 4)
+        self.assertEqual(self.client.client_table["bob"]["files"], ["x.txt", "y.txt"])
+        self.assertEqual(self.client.find_client("BOB"), "bob")
+        self.assertEqual(self.client.file_index.lookup("y.txt"), {"bob"})
+
+    def test_duplicate_delta_is_skipped(self):
+        delta = "2\nJOIN bob 10.0.0.2 5000 5001 x.txt\nFILES bob y.txt"
+        self.client.apply_delta(delta)
+        self.assertFalse(self.client.apply_delta(delta))
+        self.assertEqual(self.client.table_version, 4)
+        self.assertEqual(self.client.client_table["bob"]["files"], ["x.txt", "y.txt"])
+
+    def test_overtaken_ops_are_skipped(self):
+        # a snapshot already contains the first op of the delta
+        self.client.install_table(3, {"bob": {"ip": "10.0.0.2", "udp_port": 5000, "tcp_port": 5001,
+                                              "files": ["x.txt"], "hashes": {}, "online": True}})
+        self.assertTrue(self.client.apply_delta("2\nJOIN bob 10.0.0.2 5000 5001 x.txt\nLEAVE bob"))
+        self.assertEqual(self.client.table_version, 4)
+        self.assertFalse(self.client.client_table["bob"]["online"])
+
+    def test_gap_requests_a_snapshot(self):
+        self.assertFalse(self.client.apply_delta("3\nJOIN bob 10.0.0.2 5000 5001"))
+        self.assertEqual(self.client.table_version, 2)
+        self.assertEqual(self.client.client_table, {})
+        self.client.udp_socket.sendto.assert_called_once_with(b"SNAPSHOT a", ("127.0.0.1", 0))
+
+    def test_bump_only_moves_the_version(self):
+        self.assertFalse(self.client.apply_delta("2\nBUMP 7"))
+        self.assertEqual(self.client.table_version, 3)
+
+
+class FileIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FileIndex()
+        for filename, owner in [("report.csv", "alice"), ("report.pdf", "alice"), ("data_2024.csv", "bob"),
+                                ("notes.txt", "bob"), ("report.csv", "bob"), ("a.py", "carol")]:
+            self.index.add(filename, owner)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup("report.csv"), {"alice", "bob"})
+        self.assertEqual(self.index.lookup("missing"), set())
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix("report"), ["report.csv", "report.pdf"])
+        self.assertEqual(self.index.prefix("zzz"), [])
+
+    def test_substring(self):
+        self.assertEqual(self.index.search("port"), ["report.csv", "report.pdf"])
+        self.assertEqual(self.index.search("202"), ["data_2024.csv"])
+        # shorter than a trigram
+        self.assertEqual(self.index.search(".p"), ["a.py", "report.pdf"])
+        self.assertEqual(self.index.search("nothing"), [])
+
+    def test_glob(self):
+        self.assertEqual(self.index.search("*.csv"), ["data_2024.csv", "report.csv"])
+        self.assertEqual(self.index.search("report.*"), ["report.csv", "report.pdf"])
+        self.assertEqual(self.index.search("?.py"), ["a.py"])
+        self.assertEqual(self.index.search("*_[0-9]*"), ["data_2024.csv"])
+
+    def test_remove(self):
+        self.index.remove("report.csv", "alice")
+        self.assertEqual(self.index.lookup("report.csv"), {"bob"})
+        self.index.remove("report.csv", "bob")
+        self.assertEqual(self.index.search("*.csv"), ["data_2024.csv"])
+        self.assertEqual(self.index.search("port"), ["report.pdf"])
+
+    def test_glob_literals(self):
+        self.assertEqual(main.glob_literals("*log_?.csv"), ["", "log_", ".csv"])
+        self.assertEqual(main.glob_literals("a[0-9]b*"), ["a", "b", ""])
+
+    def test_from_table(self):
+        index = FileIndex.from_table({"alice": {"files": ["x.txt", "y.txt"]}, "bob": {"files": ["x.txt"]}})
+        self.assertEqual(index.lookup("x.txt"), {"alice", "bob"})
+        self.assertEqual(index.search("*.txt"), ["x.txt", "y.txt"])
+
+
+class ServerSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FileAppServer(0, print_interval=None)
+        self.addCleanup(self.server.udp_socket.close)
+        self.sent = []
+        self.server.sendto = lambda data, addr: self.sent.append(data)
+        for i, name in enumerate(["alice", "bob"]):
+            self.send(f"REQ {i} REGISTER {name} 10.0.0.{i + 1} 5000 5001")
+        self.send("REQ 2 OFFER alice report.csv notes.txt a_1.csv a_2.csv a_3.csv")
+        self.send("REQ 3 OFFER bob report.csv b.csv")
+
+    def send(self, message: str):
+        self.sent.clear()
+        self.server.handle_message(message.encode(), ("127.0.0.1", 4000))
+
+    def search(self, request_id: int, message: str) -> list:
+        self.send(f"REQ {request_id} SEARCH {message}")
+        return self.sent[0].decode().split(" ", 3)[3].split("\n")
+
+    def test_offline_owners_are_left_out(self):
+        self.assertEqual(self.search(10, "report"), ["0 1 1", "report.csv alice@10.0.0.1:5001,bob@10.0.0.2:5001"])
+        self.send("DISCONNECT bob")
+        self.assertEqual(self.search(11, "*.csv"), ["0 1 4", "a_1.csv alice@10.0.0.1:5001",
+                                                    "a_2.csv alice@10.0.0.1:5001", "a_3.csv alice@10.0.0.1:5001",
+                                                    "report.csv alice@10.0.0.1:5001"])
+
+    def test_pages(self):
+        with mock.patch.object(main, "SEARCH_PAGE_SIZE", 2):
+            self.assertEqual(self.search(10, "a_* 1"), ["1 2 3", "a_3.csv alice@10.0.0.1:5001"])
+            self.assertEqual(self.search(11, "a_* 5"), ["5 2 3"])
+
+    def test_no_match(self):
+        self.assertEqual(self.search(10, "zzz"), ["0 1 0"])
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(main.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wheel = TimerWheel(tick=0.5, slots=8)  # one turn of the wheel is 4 seconds
+
+    def advance(self, seconds: float) -> list:
+        self.now += seconds
+        return self.wheel.advance()
+
+    def test_expiry(self):
+        self.wheel.schedule("a", 1.0)
+        self.wheel.schedule("b", 2.0)
+        self.assertEqual(self.advance(0.5), [])
+        self.assertEqual(self.advance(0.5), ["a"])
+        self.assertEqual(self.advance(1.0), ["b"])
+        self.assertEqual(self.wheel.deadlines, {})
+
+    def test_across_wheel_turns(self):
+        self.wheel.schedule("late", 10.0)
+        self.wheel.schedule("early", 2.0)
+        expired = []
+        for _ in range(19):
+            expired += self.advance(0.5)
+        self.assertEqual(expired, ["early"])
+        self.assertEqual(self.advance(0.5), ["late"])
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule("a", 1.0)
+        self.wheel.schedule("b", 1.0)
+        self.wheel.schedule("a", 3.0)
+        self.wheel.cancel("b")
+        self.assertEqual(self.advance(1.0), [])
+        self.assertEqual(self.advance(2.0), ["a"])
+
+    def test_long_pause(self):
+        self.wheel.schedule("a", 1.0)
+        self.wheel.schedule("b", 30.0)
+        self.assertEqual(sorted(self.advance(60.0)), ["a", "b"])
+
+
+class ClientExpiryTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(main.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = FileAppServer(0, print_interval=None, heartbeat_timeout=3.0, dead_entry_ttl=10.0)
+        self.addCleanup(self.server.udp_socket.close)
+        self.server.sendto = lambda data, addr: None
+        self.send("REQ 1 REGISTER alice 127.0.0.1 5000 5001")
+        self.send("REQ 2 OFFER alice a.txt")
+
+    def send(self, message: str):
+        self.server.handle_message(message.encode(), ("127.0.0.1", 4000))
+
+    def advance(self, seconds: float):
+        self.now += seconds
+        self.server.expire_clients()
+
+    def test_heartbeats_keep_a_client_online(self):
+        for _ in range(5):
+            self.advance(2.0)
+            self.send(f"HEARTBEAT alice {self.server.table_version}")
+        self.assertTrue(self.server.client_table["alice"]["online"])
+
+    def test_silent_client_goes_offline_then_is_removed(self):
+        self.advance(2.0)
+        self.assertTrue(self.server.client_table["alice"]["online"])
+        self.advance(1.5)
+        self.assertFalse(self.server.client_table["alice"]["online"])
+        self.advance(9.0)
+        self.assertIn("alice", self.server.client_table)
+        self.advance(1.5)
+        self.assertNotIn("alice", self.server.client_table)
+        self.assertEqual(self.server.file_index.lookup("a.txt"), set())
+
+    def test_reregistration_cancels_removal(self):
+        self.advance(4.0)
+        self.send("REQ 3 REGISTER alice 127.0.0.1 5000 5001")
+        self.advance(12.0)
+        self.assertIn("alice", self.server.client_table)
+
+
+class TablePrintTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(main.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = FileAppServer(0, print_interval=2.0)
+        self.addCleanup(self.server.udp_socket.close)
+        self.server.print_client_table = mock.Mock()
+
+    def test_last_change_of_a_burst_is_printed(self):
+        for _ in range(3):
+            self.server.table_changed()
+            self.now += 0.5
+        self.assertEqual(self.server.print_client_table.call_count, 1)
+        self.server.print_due_table()
+        self.assertEqual(self.server.print_client_table.call_count, 1)
+        self.now += 0.5
+        self.server.print_due_table()
+        self.server.print_due_table()
+        self.assertEqual(self.server.print_client_table.call_count, 2)
+
+
+class SplitFileTokenTest(unittest.TestCase):
+    def test_with_hash(self):
+        self.assertEqual(split_file_token(f"a.txt:{DIGEST}"), ("a.txt", DIGEST))
+
+    def test_without_hash(self):
+        self.assertEqual(split_file_token("a.txt"), ("a.txt", None))
+
+    def test_colon_in_filename(self):
+        self.assertEqual(split_file_token(f"c:d.txt:{DIGEST}"), ("c:d.txt", DIGEST))
+        self.assertEqual(split_file_token("notes:v2"), ("notes:v2", None))
+
+    def test_not_a_hash(self):
+        self.assertEqual(split_file_token("a:" + "g" * 32), ("a:" + "g" * 32, None))
+        self.assertEqual(split_file_token("a:" + DIGEST.upper()), ("a:" + DIGEST.upper(), None))
+
+
+class FramesTest(unittest.TestCase):
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def send(self, data: bytes, codec: str) -> bytes:
+        # send all of data as frames from a thread, so large payloads don't fill the socket buffer
+        thread = threading.Thread(target=lambda: self.result.append(
+            FileAppClient.send_file_frames(self.sender, io.BytesIO(data), 0, len(data), codec)))
+        self.result = []
+        thread.start()
+        reader = PayloadReader(self.receiver, True)
+        received = bytearray(len(data))
+        reader.readinto(memoryview(received))
+        thread.join()
+        self.assertEqual(self.result, [(len(data), reader.wire_bytes)])
+        return bytes(received)
+
+    @staticmethod
+    def receive(frames: bytes, size: int) -> bytes:
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(frames)
+            received = bytearray(size)
+            PayloadReader(receiver, True).readinto(memoryview(received))
+            return bytes(received)
+
+    def test_compressible(self):
+        data = b"0123456789" * 300000
+        for codec in main.CODECS:
+            self.assertEqual(self.send(data, codec), data)
+
+    def test_incompressible_data_bypasses_compression(self):
+        data = os.urandom(3 * COMPRESSION_FRAME_SIZE + 5)
+        self.assertEqual(self.send(data, "zlib"), data)
+        # every frame went out raw, the wire only carries the frame headers on top
+        self.assertEqual(self.result[0][1], len(data) + 4 * FRAME_HEADER.size)
+
+    def test_raw_frames(self):
+        self.assertEqual(self.receive(FRAME_HEADER.pack(main.CODEC_RAW, 3) + b"abc"
+                                      + FRAME_HEADER.pack(main.CODEC_RAW, 2) + b"de", 5), b"abcde")
+
+    def test_corrupt_frames(self):
+        compressed = zlib.compress(b"x" * 1000)
+        bomb = zlib.compress(bytes(2 * COMPRESSION_FRAME_SIZE))
+        for frames in [FRAME_HEADER.pack(1, 5) + b"junk!",
+                       FRAME_HEADER.pack(1, len(compressed) - 4) + compressed[:-4],
+                       FRAME_HEADER.pack(1, len(bomb)) + bomb,
+                       FRAME_HEADER.pack(9, 1) + b"x",
+                       FRAME_HEADER.pack(main.CODEC_RAW, COMPRESSION_FRAME_SIZE + 1)]:
+            with self.assertRaises(ValueError):
+                self.receive(frames, 1000)
+
+
+class TokenBucketTest(unittest.TestCase):
+    RATE = 20 * main.SHAPING_QUANTUM  # the bucket holds one quantum, refilled 20 times a second
+
+    def test_rate(self):
+        bucket = TokenBucket(self.RATE)
+        start = time.perf_counter()
+        for _ in range(10):
+            bucket.acquire(main.SHAPING_QUANTUM)
+        # the first quantum is the burst, the other nine take 0.45 seconds
+        self.assertAlmostEqual(time.perf_counter() - start, 0.45, delta=0.15)
+
+    def test_large_request_leaves_debt(self):
+        bucket = TokenBucket(self.RATE)
+        start = time.perf_counter()
+        bucket.acquire(4 * main.SHAPING_QUANTUM)
+        self.assertLess(time.perf_counter() - start, 0.05)
+        bucket.acquire(1)
+        self.assertAlmostEqual(time.perf_counter() - start, 0.15, delta=0.1)
+
+    def test_shared_bucket_is_fair(self):
+        # two uploads of five quanta each take turns, so they finish one quantum apart instead of one
+        # finishing all of its quanta before the other
+        bucket = TokenBucket(self.RATE)
+        bucket.acquire(main.SHAPING_QUANTUM)  # empty, so both uploads are queued before the first refill
+        barrier = threading.Barrier(2)
+        finished = [0.0, 0.0]
+
+        def upload(i):
+            barrier.wait()
+            for _ in range(5):
+                bucket.acquire(main.SHAPING_QUANTUM)
+            finished[i] = time.perf_counter()
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(2)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(abs(finished[0] - finished[1]), 0.08)
+        self.assertAlmostEqual(max(finished) - start, 0.5, delta=0.15)
+
+    def test_shaper_counts_throttled_time(self):
+        shaper = main.UploadShaper([TokenBucket(self.RATE), TokenBucket(2 * self.RATE)])
+        for _ in range(3):
+            shaper.acquire(main.SHAPING_QUANTUM)
+        self.assertAlmostEqual(shaper.throttled, 0.1, delta=0.05)
+
+
+class CopyFromLocalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.client = FileAppClient("a", "127.0.0.1", 0, 0, 0)
+        self.addCleanup(self.client.udp_socket.close)
+        self.addCleanup(self.client.tcp_socket.close)
+        self.client.dir = directory.name
+        self.source = self.write("source.bin", b"x" * 5000)
+        self.digest = self.client.local_content_hash(self.source)
+        self.client.local_content[self.digest] = self.source
+
+    def write(self, filename: str, data: bytes) -> str:
+        path = os.path.join(self.client.dir, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_copies_same_content(self):
+        self.assertTrue(self.client.copy_from_local("sub/copy.bin", self.digest))
+        self.assertEqual(self.read(os.path.join(self.client.dir, "sub", "copy.bin")), b"x" * 5000)
+
+    def test_replaces_other_content(self):
+        path = self.write("copy.bin", b"old")
+        self.assertTrue(self.client.copy_from_local("copy.bin", self.digest))
+        self.assertEqual(self.read(path), b"x" * 5000)
+        self.assertEqual(self.read(self.source), b"x" * 5000)
+
+    def test_unknown_or_changed_content(self):
+        self.assertFalse(self.client.copy_from_local("copy.bin", None))
+        self.assertFalse(self.client.copy_from_local("copy.bin", "f" * 32))
+        # the remembered file no longer has that content
+        self.write("source.bin", b"y" * 4000)
+        self.assertFalse(self.client.copy_from_local("copy.bin", self.digest))
+        self.assertFalse(os.path.exists(os.path.join(self.client.dir, "copy.bin")))
+
+
+class DownloadJournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "file.bin")
+        self.size = 5 * CHUNK_SIZE + 100
+        self.digests = [bytes([i]) * 32 for i in range(6)]
+
+    def open(self) -> DownloadJournal:
+        journal = DownloadJournal.open(self.path, self.size, self.digests)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_fresh_download(self):
+        journal = self.open()
+        self.assertFalse(journal.resumed)
+        self.assertEqual(journal.missing_ranges(), [(0, self.size)])
+        self.assertEqual(os.path.getsize(self.path), self.size)
+
+    def test_gaps(self):
+        journal = self.open()
+        journal.mark(0, 1)
+        journal.mark(2, 2)
+        journal.mark(5, 1)
+        self.assertEqual(journal.missing_ranges(), [(CHUNK_SIZE, 2 * CHUNK_SIZE), (4 * CHUNK_SIZE, 5 * CHUNK_SIZE)])
+
+    def test_last_chunk_is_short(self):
+        journal = self.open()
+        journal.mark(0, 5)
+        self.assertEqual(journal.missing_ranges(), [(5 * CHUNK_SIZE, self.size)])
+        journal.mark(5, 1)
+        self.assertEqual(journal.missing_ranges(), [])
+
+    def test_resume(self):
+        journal = self.open()
+        journal.mark(1, 3)
+        journal.close()
+        with open(self.path + DownloadJournal.SUFFIX, "a") as f:
+            f.write("4")  # a line cut short by a crash
+        resumed = self.open()
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.missing_ranges(), [(0, CHUNK_SIZE), (4 * CHUNK_SIZE, self.size)])
+
+    def test_other_content_starts_over(self):
+        journal = self.open()
+        journal.mark(0, 3)
+        journal.close()
+        self.digests[0] = b"\xff" * 32
+        restarted = self.open()
+        self.assertFalse(restarted.resumed)
+        self.assertEqual(restarted.missing_ranges(), [(0, self.size)])
+
+    def test_verify(self):
+        journal = self.open()
+        data = b"x" * CHUNK_SIZE
+        journal.digests[1] = main.hashlib.sha256(data).digest()
+        self.assertTrue(journal.verify(1, data))
+        self.assertFalse(journal.verify(1, data[:-1] + b"y"))
+        self.assertFalse(journal.verify(0, data))
+        self.assertFalse(journal.verify(6, data))
+
+    def test_complete_removes_journal(self):
+        journal = self.open()
+        journal.mark(0, 6)
+        journal.complete()
+        self.assertFalse(os.path.exists(self.path + DownloadJournal.SUFFIX))
+        self.assertEqual(os.path.getsize(self.path), self.size)
+
+    def test_hardlinked_destination_is_replaced(self):
+        # a duplicate download is hardlinked to the local file with the same content, downloading
+        # new content to that name later must leave the other file alone
+        source = self.path + ".source"
+        with open(source, "wb") as f:
+            f.write(b"x" * 5000)
+        os.link(source, self.path)
+        journal = self.open()
+        with open(self.path, "r+b") as f:
+            f.write(b"y" * 100)
+        with open(source, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 5000)
+        self.assertEqual(os.path.getsize(self.path), self.size)
+        self.assertFalse(journal.resumed)
+
+    def test_hardlinked_destination_is_not_resumed(self):
+        journal = self.open()
+        journal.mark(0, 2)
+        journal.close()
+        os.link(self.path, self.path + ".copy")
+        self.assertFalse(self.open().resumed)
+
+
+class HandleRequestTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, "f"), "wb") as f:
+            f.write(b"0123456789")
+        self.client = FileAppClient("a", "127.0.0.1", 0, 0, 0)
+        self.addCleanup(self.client.udp_socket.close)
+        self.addCleanup(self.client.tcp_socket.close)
+        self.client.dir = directory.name
+        self.conn, self.peer = socket.socketpair()
+        self.addCleanup(self.conn.close)
+        self.addCleanup(self.peer.close)
+
+    def request(self, message: str) -> tuple:
+        self.client.handle_request(self.conn, ("127.0.0.1", 4000), message)
+        status, file_size, length = RESPONSE_HEADER.unpack(FileAppClient.recv_exact(self.peer, RESPONSE_HEADER.size))
+        return status, length, FileAppClient.recv_exact(self.peer, length) if status == STATUS_OK else b""
+
+    def test_ranges(self):
+        self.assertEqual(self.request("REQUEST f"), (STATUS_OK, 10, b"0123456789"))
+        self.assertEqual(self.request("REQUEST f 2 3"), (STATUS_OK, 3, b"234"))
+        self.assertEqual(self.request("REQUEST f 8 100"), (STATUS_OK, 2, b"89"))
+        self.assertEqual(self.request("REQUEST f 50 5"), (STATUS_OK, 0, b""))
+
+    def test_invalid_ranges(self):
+        for message in ["REQUEST f 5", "REQUEST f -1 5", "REQUEST f 2 -3", "REQUEST f 1 2 3", "REQUEST f a b",
+                        "REQUEST f 1.5 2"]:
+            self.assertEqual(self.request(message), (STATUS_NOT_FOUND, 0, b""), message)
+        # the connection is still in sync
+        self.assertEqual(self.request("REQUEST f 0 1"), (STATUS_OK, 1, b"0"))
+
+
+class StateLogTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.log_path = os.path.join(self.directory, main.StateLog.LOG_NAME)
+
+    def open(self) -> main.StateLog:
+        state = main.StateLog(self.directory)
+        self.addCleanup(lambda: state.log_file.close())
+        return state
+
+    def write_log(self, text: str):
+        with open(self.log_path, "w") as f:
+            f.write(text)
+
+    def test_replay(self):
+        state = self.open()
+        state.load()
+        state.append(1, "JOIN alice 10.0.0.1 5000 5001 a.txt")
+        state.append(2, "FILES alice b.txt")
+        version, table, index = self.open().load()
+        self.assertEqual(version, 2)
+        self.assertEqual(table["alice"]["files"], ["a.txt", "b.txt"])
+        self.assertEqual(index.lookup("b.txt"), {"alice"})
+
+    def test_torn_last_line(self):
+        self.write_log("1 JOIN alice 10.0.0.1 5000 5001\n2 FILES alice a.t")
+        state = self.open()
+        version, table, _ = state.load()
+        self.assertEqual((version, table["alice"]["files"]), (1, []))
+        # the torn line is cut off, the next one starts on a line of its own
+        state.append(2, "FILES alice b.txt")
+        self.assertEqual(self.open().load()[1]["alice"]["files"], ["b.txt"])
+
+    def test_gap_stops_replay(self):
+        self.write_log("1 JOIN alice 10.0.0.1 5000 5001\n2 FILES alice a.txt\n4 FILES alice c.txt\n5 LEAVE alice\n")
+        version, table, _ = self.open().load()
+        self.assertEqual(version, 2)
+        self.assertEqual(table["alice"]["files"], ["a.txt"])
+        self.assertTrue(table["alice"]["online"])
+        with open(self.log_path) as f:
+            self.assertEqual(f.read(), "1 JOIN alice 10.0.0.1 5000 5001\n2 FILES alice a.txt\n")
+
+    def test_lines_in_the_snapshot_are_skipped(self):
+        state = self.open()
+        state.load()
+        table = {"alice": {"ip": "10.0.0.1", "udp_port": 5000, "tcp_port": 5001, "files": ["a.txt"], "hashes": {},
+                           "online": False}}
+        state.compact(2, table)
+        # a crash between writing the snapshot and clearing the log leaves the old lines behind
+        self.write_log("1 JOIN alice 10.0.0.1 5000 5001 a.txt\n2 LEAVE alice\n3 FILES alice b.txt\n")
+        version, restored, _ = self.open().load()
+        self.assertEqual(version, 3)
+        self.assertFalse(restored["alice"]["online"])
+        self.assertEqual(restored["alice"]["files"], ["a.txt", "b.txt"])
+
+    def test_unreadable_and_invalid_lines(self):
+        self.write_log("1 JOIN alice 10.0.0.1 5000 5001\nnot a version\n2 JOIN bob 10.0.0.2\n3 FILES alice a.txt\n")
+        version, table, _ = self.open().load()
+        self.assertEqual(version, 3)
+        self.assertEqual(list(table), ["alice"])
+        self.assertEqual(table["alice"]["files"], ["a.txt"])
+
+    def test_restore_drops_rows_that_cannot_be_encoded(self):
+        self.write_log("1 JOIN bad 10.0.0.1 70000 5001 x.txt\n2 JOIN alice 10.0.0.1 5000 5001 a.txt\n")
+        version, table, index = self.open().load()
+        self.assertEqual(version, 2)
+        self.assertEqual(list(table), ["alice"])
+        self.assertEqual(index.lookup("x.txt"), set())
+        self.assertEqual(decode_table(encode_table(version, table)), (2, table))
+
+
+if __name__ == "__main__":
+    unittest.main()